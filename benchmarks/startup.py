@@ -0,0 +1,148 @@
+# /usr/bin/python3
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Hemiplasy Tool
+Authors: Matt Gibson, Mark Hibbins
+Indiana University
+
+Startup benchmark of the console scripts. Each entry point is run in a
+fresh interpreter on a tiny real input: heist on the example input with
+stub ms and seq-gen programs (200 replicates), newick2ms and subs2coal on
+one tree, and heistMerge on the output of that heist run. The time of
+each run above a bare interpreter is compared with the command's budget,
+and the modules loaded once the run is over are checked against the heavy
+ones it must not import. Exits with status 1 if a budget is exceeded or a
+heavy module is loaded.
+
+Usage: python benchmarks/startup.py [-r REPEAT]
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE = os.path.join(ROOT, "example", "heist_example_input.txt")
+
+# Entry point of each command, its arguments (with {dir} the scratch
+# directory), its budget above a bare interpreter (milliseconds) and the
+# heavy modules it must not load
+COMMANDS = {
+    "heist": ("main", ["-n", "200", "-t", "1", "--seed", "1", "-p", "{dir}/ms", "-g", "{dir}/seq-gen",
+                       "-o", "{dir}/run", EXAMPLE], 1500, ["matplotlib"]),
+    "newick2ms": ("newick2ms", ["{dir}/coal.tree"], 100, ["numpy", "matplotlib", "numba"]),
+    "subs2coal": ("subs2coal", ["{dir}/subs.tree"], 250, ["matplotlib", "numba"]),
+    "heistMerge": ("heistMerge", ["-o", "{dir}/merged", "{dir}/run", "{dir}/run"], 100,
+                   ["numpy", "matplotlib", "numba"]),
+}
+
+# Runs an entry point, then writes the top level modules it loaded
+SNIPPET = """
+import sys, os
+sys.argv = sys.argv[1:]
+out = sys.stdout
+sys.stdout = open(os.devnull, "w")
+from heist import __main__
+try:
+    getattr(__main__, "{func}")()
+except SystemExit as e:
+    if e.code not in (None, 0):
+        raise
+out.write(" ".join(sorted(set([m.split(".")[0] for m in sys.modules]))))
+"""
+
+# Stub ms: the replicates asked for, as caterpillar trees of the samples in
+# an order that varies between replicates
+STUB_MS = """
+import sys, random
+nsam, nreps = int(sys.argv[1]), int(sys.argv[2])
+rng = random.Random(nreps)
+out = ["ms " + " ".join(sys.argv[1:]), "1 2 3", ""]
+for r in range(nreps):
+    leaves = [str(x) for x in range(1, nsam + 1)]
+    rng.shuffle(leaves)
+    tree = "(" + leaves[0] + ":0.1," + leaves[1] + ":0.1)"
+    for i, leaf in enumerate(leaves[2:]):
+        tree = "(" + tree + ":0.1," + leaf + ":" + str(0.1 * (i + 2)) + ")"
+    out += ["//", tree + ";"]
+sys.stdout.write("\\n".join(out) + "\\n")
+"""
+
+# Stub seq-gen -wa: one site per tree, with the nodes in preorder (the
+# internal nodes of the caterpillar, then its leaves) and random states
+STUB_SEQGEN = """
+import sys, re, random
+rng = random.Random(1)
+out = []
+for line in sys.stdin:
+    leaves = re.findall(r"[(,](\\d+):", line)
+    if not leaves:
+        continue
+    n = len(leaves)
+    out.append(" " + str(n) + " 1")
+    out += [str(label) + "\\t" + rng.choice("AC") for label in list(range(n + 1, 2 * n)) + leaves]
+sys.stdout.write("\\n".join(out) + "\\n")
+"""
+
+COAL_TREE = "((sp1:1.0,sp2:1.0):0.5,(sp3:0.7,sp4:0.7):0.8);\n"
+SUBS_TREE = "(sp1:0.002,(sp2:0.001,((sp3:0.0004,sp4:0.0008)10.0:0.0005,(sp5:0.0006,sp6:0.0004)8.0:0.0004)15.0:0.0009)90.0:0.005);\n"
+
+
+def run(code, args, cwd=None):
+    """Wall time (seconds) and standard output of a fresh interpreter running code."""
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code] + args, env=env, cwd=cwd,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start, result.stdout.decode("utf-8"))
+
+
+def setup(directory):
+    """Writes the stub simulators and input trees to directory."""
+    for name, code in [["ms", STUB_MS], ["seq-gen", STUB_SEQGEN]]:
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write("#!" + sys.executable + "\n" + code)
+        os.chmod(path, 0o755)
+    for name, tree in [["coal.tree", COAL_TREE], ["subs.tree", SUBS_TREE]]:
+        with open(os.path.join(directory, name), "w") as f:
+            f.write(tree)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the HeiST console scripts.")
+    parser.add_argument("-r", "--repeat", metavar="", type=int, default=10,
+                        help="Runs per command; the fastest is reported (default 10)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="heist_startup_")
+    try:
+        setup(directory)
+        bare = min([run("pass", [])[0] for i in range(args.repeat)])
+        print("Bare interpreter: %.1f ms\n" % (bare * 1000))
+        print("Command\t\tRun (ms)\tBudget (ms)\tHeavy modules")
+
+        failed = False
+        for name, (func, argv, budget, heavy) in COMMANDS.items():
+            argv = [name] + [a.format(dir=directory) for a in argv]
+            times = []
+            for i in range(args.repeat):
+                elapsed, modules = run(SNIPPET.format(func=func), argv, directory)
+                times.append(elapsed)
+            startup = (min(times) - bare) * 1000
+            loaded = [m for m in heavy if m in modules.split()]
+            if startup > budget or loaded:
+                failed = True
+            print("%s\t%s%.1f\t\t%d\t\t%s" % (name, "\t" if len(name) < 8 else "", startup, budget,
+                                              ", ".join(loaded) if loaded else "none"))
+    finally:
+        shutil.rmtree(directory)
+    if failed:
+        sys.exit("Error: startup budget exceeded")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,10 @@
 HemiplasyTool
 Authors: Matt Gibson, Mark Hibbins
 Indiana University
+
+Entry points of the console scripts. Each one imports only what it uses:
+NumPy, seqtools and its compiled kernels are loaded by heist itself, not
+by newick2ms, subs2coal or heistMerge.
 """
 
 import argparse
@@ -11,11 +15,13 @@ import time
 import sys
 import os
 import logging as log
-import subprocess
+import random
+import atexit
+import glob
+import shutil
+import importlib.util
 from heist import hemiplasytool
-from heist import seqtools
-from Bio import Phylo
-from ete3 import Tree
+from heist import cache
 
 def newick2ms(*args):
     parser = argparse.ArgumentParser(
@@ -30,11 +36,29 @@ def newick2ms(*args):
         metavar="input",
         help="Input newick string file"
     )
+    parser.add_argument(
+        "-b", "--batch", action="store_true",
+        help="Convert every tree in the input file (one newick string per line), writing one line per tree: the ms split flags, then a tab and the taxon codes (name=code, comma separated)"
+    )
     args = parser.parse_args()
 
+    if args.batch:
+        with open(args.input, 'r') as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                tree, conversions = hemiplasytool.names2ints(line, None, 'coal')
+                splits, taxa = hemiplasytool.newick2ms(tree)
+                call = ""
+                for x, split in enumerate(splits):
+                    call += " -ej " + str(split) + " " + str(taxa[x][0]) + " " + str(taxa[x][1])
+                codes = [str(key) + "=" + str(val) for key, val in conversions.items()]
+                sys.stdout.write(call.strip() + "\t" + ",".join(codes) + "\n")
+        return
+
     newick = open(args.input, 'r').read()
     
-    tree, conversions = hemiplasytool.names2ints(newick)
+    tree, conversions = hemiplasytool.names2ints(newick, None, 'coal')
 
     splits, taxa = hemiplasytool.newick2ms(tree)
 
@@ -71,12 +95,26 @@ def subs2coal(*args):
         metavar="input",
         help="Input newick string file"
     )
+    parser.add_argument(
+        "-b", "--batch", action="store_true",
+        help="Convert every tree in the input file (one newick string or NEXUS tree line per line), writing one line per tree"
+    )
+    parser.add_argument(
+        "-c", "--CI", metavar="", choices=["lower", "upper", "all"], default=None,
+        help="Write the tree at the lower ('lower') or upper ('upper') bound of the 95 %% CI instead of the point estimate, or all three, tab separated ('all')"
+    )
     args = parser.parse_args()
 
-    newick = open(args.input, 'r').read()
+    if args.batch:
+        newicks = hemiplasytool.readTrees(args.input)
+    else:
+        newick = open(args.input, 'r').read()
+        newicks = [newick[newick.find("("):] if "(" in newick else newick]
+    bounds = {None: [0], "lower": [2], "upper": [4], "all": [0, 2, 4]}[args.CI]
 
-    treeSp,t,treeSp_lower_CI,t_lower_CI,treeSp_upper_CI,t_upper_CI,intercept,coef,n,c = hemiplasytool.subs2coal(newick)
-    print(treeSp)
+    for newick in newicks:
+        result = hemiplasytool.subs2coal(newick)
+        sys.stdout.write("\t".join([result[i] for i in bounds]) + "\n")
 
 def heistMerge(*args):
     parser = argparse.ArgumentParser(
@@ -86,133 +124,99 @@ def heistMerge(*args):
     parser.add_argument(
         "-d", help="Merge all files in a directory", action='store_true'
     )
+    parser.add_argument(
+        "-t", "--threads", metavar="", type=int, help="Number of threads reading and merging runs (default 8)", default=8
+    )
+    parser.add_argument(
+        "-o", "--output", metavar="", help="Also write the merged output to <prefix>.txt and <prefix>_raw.txt, which can be merged again, and the trees to <prefix>.trees (default: trees to merged_trees.trees)", default=None
+    )
+    parser.add_argument(
+        "-a", "--append", action="store_true", help="Merge the runs into the existing merged output at --output instead of overwriting it"
+    )
     parser.add_argument("inputs", nargs="*", help = "Prefixes of output files to merge or a directory (supply -d flag as well)")
     args = parser.parse_args()
     files = args.inputs
-    
+
     if args.d == True:
-        direc = str(files[0])
-        result = subprocess.run('echo ' + str(direc) + '/*_raw.txt', stdout=subprocess.PIPE, shell=True)
-        
-        files2 = result.stdout.split()
-        files3 = []
-        for file in files2:
-            file = str(file.decode("utf-8"))
-            files3.append(file.replace('_raw.txt', ''))
+        files3 = [f[:-len("_raw.txt")] for f in sorted(glob.glob(os.path.join(str(files[0]), "*_raw.txt")))]
     else:
         files3 = files
-    #Get info that is same across all runs
-
-    head = ""
-    file1 = open(files3[0] + ".txt")
-    for line in file1:
-        if not line.startswith('### RESULTS ###'):
-            head += line
-        if line.startswith('### RESULTS ###'):
-            break
-    
-    data = {"#1": 0, "#2": 0, "#3": 0, "#4": 0, "#5": 0,
-            "#6": 0, "#7": 0, "#8": 0}
-    allT = {}
-    discT = {}
-    concT = {}
-    taxaT_1 = {}
-    taxaT_2 = {}
-    taxaT_3 = {}
-
-    for file in files3:
-        f = open(file + "_raw.txt")
-        for i, line in enumerate(f):
-            if i == 0:
-                data["#1"] += int(line)
-            elif i == 1:
-                data["#2"] += int(line)
-            elif i == 2:
-                data["#3"] += int(line)
-            elif i == 3:
-                data["#4"] += int(line)
-            elif i == 4:
-                data["#5"] += int(line)
-            elif i == 5:
-                data["#6"] += int(line)
-            elif i == 6:
-                data["#7"] += int(line)
-            elif i == 7:
-                data["#8"] += int(line)
-            elif i == 8:
-                data["#9"] += float(line)
-            else:
-                l = line.replace('\n', '').split(',')
-                if l[0] == 'All':
-                    if l[1] in allT.keys():
-                        allT[l[1]] += int(l[2])
-                    else:
-                        allT[l[1]] = int(l[2])
-                elif l[0] == 'Disc':
-                    if l[1] in discT.keys():
-                        discT[l[1]] += int(l[2])
-                    else:
-                        discT[l[1]] = int(l[2])
-                elif l[0] == 'Conc':
-                    if l[1] in concT.keys():
-                        concT[l[1]] += int(l[2])
-                    else:
-                        concT[l[1]] = int(l[2])
-                elif l[0].startswith("Taxa"):
-                    if l[0] in taxaT_1.keys():
-                        taxaT_1[l[0]] += int(l[1])
-                        taxaT_2[l[0]] += int(l[2])
-                        taxaT_3[l[0]] += int(l[3])
-                    else:
-                        taxaT_1[l[0]] = int(l[1])
-                        taxaT_2[l[0]] = int(l[2])
-                        taxaT_3[l[0]] = int(l[3])
-    print(head)
-
-    print("### RESULTS ###")
-    print(str(data["#1"]) + ' loci matched the species character states\n')
-    print('"True" hemiplasy (1 mutation) occurs ' + str(data["#2"]) + " time(s)\n")
-    print("Combinations of hemiplasy and homoplasy (1 < # mutations < "
-            + "____"
-            + ") occur "
-            + str(data["#3"])
-            + " time(s)\n"
-        )
-    print(
-        '"True" homoplasy (>= ' + "______" + ' mutations) occurs ' + str(data["#4"]) + " time(s)\n"
-    )
-    
-    print(str(data["#5"]) + " loci have a discordant gene tree\n")
-    print(str(data["#6"]) + " loci are concordant with the species tree\n")
-    print(str(data["#7"]) + " loci originate from an introgressed history\n")
-    print(str(data["#8"]) + " loci originate from the species history\n")
-
-
-    print('Distribution of mutation counts:\n')
-    print("# Mutations\t# Trees")
-
-    print("On all trees:")
-    for key, val in allT.items():
-        print(str(key) + '\t\t' + str(val))
-    print("\nOn concordant trees:")
-    for key, val in concT.items():
-        print(str(key) + '\t\t' + str(val))
-    print("\nOn discordant trees:")
-    for key, val in discT.items():
-        print(str(key) + '\t\t' + str(val))
-    print()
+    if args.output != None:
+        files3 = [f for f in files3 if os.path.abspath(f) != os.path.abspath(args.output)]
+    if args.append:
+        if args.output == None:
+            sys.exit("Error: --append requires --output")
+        if os.path.exists(args.output + "_raw.txt"):
+            # The merged output is read as the first run; its trees are kept
+            files3 = [args.output] + files3
+        else:
+            args.append = False
+    if len(files3) == 0:
+        sys.exit("Error: no HeiST runs to merge")
 
-    print("\nOrigins of mutations leading to observed character states for hemiplasy + homoplasy cases:\n")
-    print("\tTip mutation\tInternal branch mutation\tTip reversal")
-    for key, val in taxaT_1.items():
-        print(key + "\t" + str(val) + "\t" + str(taxaT_2[key]) + "\t" + str(taxaT_3[key]))
+    merged = hemiplasytool.reduce_shards(files3, max(1, args.threads))
+    if args.output != None:
+        hemiplasytool.write_merged(merged, args.output)
+    sys.stdout.write(hemiplasytool.format_merged(merged))
 
-    tree_files = [x + ".trees" for x in files3]
-    catcall = "cat "
+    tree_files = [x + ".trees" for x in files3[1 if args.append else 0:]]
     for t in tree_files:
-        catcall += t + " "
-    catcall += "> merged_trees.trees"
-    os.system(catcall)
+        if not os.path.exists(t):
+            sys.stderr.write("Warning: " + t + " not found, its trees are not merged\n")
+    hemiplasytool.cat_files([t for t in tree_files if os.path.exists(t)],
+        "merged_trees.trees" if args.output == None else args.output + ".trees", args.append)
+
+def analyze_variant(prefix, chunks, scans, traits, treeSp, admix, threads=1, sink=None, records=False, pool=None):
+    """
+    Classifies the simulated loci of one species tree variant that match
+    the species character states, from the results of its chunks'
+    hemiplasytool.scan_chunk (scans, in chunk order), simulated under the
+    introgression events admix. The focal loci are streamed in batches;
+    sink is called with each batch of focal trees, in order. With records,
+    per-locus records are written to prefix.loci. The focal loci are
+    summarized on pool, if given.
+    """
+    from heist import seqtools
+    from heist import aggregate
+    ntaxa = len(traits)
+    hemiplasytool.cat_trees([prefix + ".trees" + c[0] + ".tmp" for c in chunks], prefix + ".trees.tmp",
+        [s[1] for s in scans])
+    hemiplasytool.cat_files([prefix + ".seqs" + c[0] + ".focaltrees.tmp" for c in chunks],
+        prefix + ".focaltrees.tmp")
+
+    # Chunk match indices, offset by the loci of the chunks before
+    nfocal = 0
+    counts_by_tree = [0, 0]
+    start = 0
+    with open(prefix + ".trees.match.tmp", "wb") as tmpMatch:
+        for c, s in zip(chunks, scans):
+            (seqtools.read_array(prefix + ".seqs" + c[0] + ".trees.match.tmp") + start).tofile(tmpMatch)
+            start += s[0]
+            nfocal += s[2]
+            counts_by_tree = [x + y for x, y in zip(counts_by_tree, s[3])]
+
+    nderived = 0
+    for trait in traits.values():
+        if trait == 1:
+            nderived += 1
+    log.debug("Summarizing " + str(nfocal) + " focal trees...")
+    focal = aggregate.summarize_focal(prefix + ".trees.tmp", prefix + ".focaltrees.tmp",
+        prefix + ".trees.match.tmp", treeSp, ntaxa, nderived, threads, sink,
+        prefix + ".loci" if records else None, hemiplasytool.history_breaks(chunks, admix), pool)
+    assert focal.nloci == nfocal
+
+    # Begin summary of all batches
+    mutation_counts_d = focal.mutation_counts(discordant=True)
+    mutation_counts_c = focal.mutation_counts()
+    summary = hemiplasytool.summarize({0: [focal.ndiscordant, focal.nloci]})
+    mutation_pat = focal.origins()
+    if len(mutation_pat) == 0:
+        mutation_pat = None
+        log.debug(
+            "Not enough 'interesting' cases to provide mutation inheritance patterns"
+        )
+    return (summary, mutation_counts_c, mutation_counts_d, mutation_pat, counts_by_tree, focal.topologies)
+
 
 def main(*args):
     start = time.time()
@@ -258,11 +262,47 @@ def main(*args):
     )
 
     parser.add_argument(
-        "-c", "--CI", metavar="", help="Optionally simulate at the upper ('upper') or lower ('lower') bounds of the 95 %% CI for the coalescent conversion regression.", default=None
+        "-c", "--CI", metavar="", choices=["lower", "upper", "all"], help="Optionally simulate at the upper ('upper') or lower ('lower') bounds of the 95 %% CI for the coalescent conversion regression, or at the point estimate and both bounds together ('all').", default=None
+    )
+    parser.add_argument(
+        "--seed", metavar="", type=int, help="Random seed for ms and seq-gen (default: random)", default=None
+    )
+    parser.add_argument(
+        "--trees", metavar="", help="File of species trees (one per line) to simulate instead of tree_1, e.g. bootstrap or posterior trees. Replicates are divided among the trees.", default=None
+    )
+    parser.add_argument(
+        "--cache", metavar="", help="Directory of cached simulations to reuse across runs with the same --seed (default: no cache)", default=None
+    )
+    parser.add_argument(
+        "--cachesize", metavar="", type=float, help="Maximum size of the simulation cache in GB (default 10)", default=10
+    )
+    parser.add_argument(
+        "--topologycache", metavar="", type=int, help="Number of gene tree topologies to keep in memory (default 10000)", default=10000
+    )
+    parser.add_argument(
+        "--top", metavar="", type=int, help="Number of most frequent gene tree topologies to draw in the output (default: all)", default=None
+    )
+    parser.add_argument(
+        "--records", action="store_true", help="Also write per-locus records of the focal loci (topology, branch lengths, origin, mutations, concordance) as NumPy arrays to <prefix>.loci/"
+    )
+    parser.add_argument(
+        "--compress", metavar="", choices=["gzip", "zstd"], help="Compress the intermediate gene tree and sequence files with 'gzip' or 'zstd' to save scratch space (default: uncompressed)", default=None
+    )
+    parser.add_argument(
+        "--db", metavar="", help="SQLite database file to add the results to (run parameters, summary counts, mutation counts, origins and topologies), e.g. shared by many runs (default: none)", default=None
+    )
+    parser.add_argument(
+        "--dbjournal", metavar="", choices=["wal", "delete"], help="Journal mode of the --db database: 'wal' lets queries run while runs are added but needs a local filesystem, 'delete' also works on network filesystems such as NFS (default wal)", default="wal"
     )
     parser.add_argument("-o", "--outputdir", metavar="", help="Output directory/prefix")
 
     args = parser.parse_args()
+    from heist import seqtools
+    atexit.register(hemiplasytool.cleanup_earlyexit)
+    if args.compress != None and shutil.which(args.compress) == None:
+        sys.exit("Error: --compress " + args.compress + " requires the " + args.compress + " program")
+    if args.compress == "zstd" and importlib.util.find_spec("zstandard") == None:
+        sys.exit("Error: --compress zstd requires the zstandard Python package (pip install heist-hemiplasy[zstd])")
 
     # Setup ###################
     log.basicConfig(level=log.DEBUG)
@@ -279,311 +319,209 @@ def main(*args):
     # Read input file
     log.debug("Reading input file...")
     treeSp, derived, admix, outgroup, type, tree2, conversion_type = hemiplasytool.readInput(args.input)
-    tmp1 = Tree(treeSp, format = 1)
-    tmp1.convert_to_ultrametric()
 
-
-
-    if type != 'coal':
-        # Convert ML tree to a coalescent tree based on GCFs
-        treeSp, t, treeSp_low, t_low, treeSp_up, t_up, intercept, coef, newick_internals, coal_internals = hemiplasytool.subs2coal(treeSp)
-        original_tree = [treeSp, t]
+    intercept, coef, newick_internals, coal_internals = [None]*4
+    variants = {}
+    if args.trees != None:
+        if args.CI == 'all':
+            sys.exit("Error: --CI all cannot be combined with --trees")
+        if type != 'coal' and args.CI != None:
+            bound = {'lower': 2, 'upper': 4}[args.CI]
+        else:
+            bound = 0
+        for i, newick in enumerate(hemiplasytool.readTrees(args.trees)):
+            if type != 'coal':
+                newick = hemiplasytool.subs2coal(newick)[bound]
+            variants["tree_" + str(i + 1)] = newick
+        labels = list(variants.keys())
+        log.debug("Read " + str(len(labels)) + " species trees")
     else:
-        original_tree = [treeSp, Tree(treeSp, format=1)]
-
-    sim_type = args.CI
-
-    if sim_type != None:
-        if sim_type == 'upper':
-            treeSp = treeSp_up
-            t = t_up
-        elif sim_type == 'lower':
-            treeSp = treeSp_low
-            t = t_low
-    # Tree pruning
-    if outgroup != None:
-        log.debug("Pruning tree...")
-        # Prune tree
-        treeSp,t = hemiplasytool.prune_tree(treeSp, derived, outgroup)
-        tree2,t2 = hemiplasytool.prune_tree(tree2, derived, outgroup)
-
-
-    taxalist = [i.name for i in t.iter_leaves()]
-    [i.name for i in t.iter_leaves()]
-
-    # Convert coalescent tree to ms splits
-
-
-
-    treeSp, conversions = hemiplasytool.names2ints(treeSp, conversion_type, type)
-    original_tree[0], tmp = hemiplasytool.names2ints(original_tree[0], conversion_type, type)
-
-    # Convert newick tree to ms splits
-    splits, taxa = hemiplasytool.newick2ms(treeSp)
-    traits = {}
-    for i in taxalist:
-        if i in derived:
-            traits[conversions[i]] = 1
+        if type != 'coal':
+            # Convert ML tree to a coalescent tree based on GCFs
+            treeSp, t, treeSp_low, t_low, treeSp_up, t_up, intercept, coef, newick_internals, coal_internals = hemiplasytool.subs2coal(treeSp)
+            variants = {'point': treeSp, 'lower': treeSp_low, 'upper': treeSp_up}
         else:
-            traits[conversions[i]] = 0
-
-
-    #Generate tree in ete3 with internal branches labeled based on user input
-    #plus how ms interprets them. e.g., I4(3). This way I can easily specify the
-    #events to ms.
-    if len(admix) != 0:
-        tree2_ete, tree2_newick, node_conversions = hemiplasytool.make_introgression_tree(tree2, conversions)
+            variants = {'point': treeSp}
 
-    
-        #Update conversion dictionary to contain node conversions (e.g. I4 -> 2)
-        conversions = {**conversions, **node_conversions}
-
-        #Perform conversions on admix list
-        events = []
-
-        #Parse admix list, divide times by 2
-        for e in admix:
-            events.append([str(float(e[0])/2.0), str(conversions[e[1]]), str(conversions[e[2]]), e[3]])
-        admix = events
-
-        #Sort admix list earliest to latest (not sure if ms requires this or not)
+        # Species tree variants to simulate
+        if args.CI == 'all':
+            labels = ['point', 'lower', 'upper']
+        elif args.CI != None:
+            labels = [args.CI]
+        else:
+            labels = ['point']
+        for label in labels:
+            if label not in variants:
+                sys.exit("Error: CI bounds are only available for trees converted from substitution units")
+
+    # Prune, convert to ms integer codes and ms splits
+    species = {}
+    for label in labels:
+        species[label] = hemiplasytool.prepare_species_tree(variants[label], derived, outgroup, conversion_type, type)
+    conversions = species[labels[0]][3]
+
+    # Introgression events as given (taxon names and user times), in the
+    # order convert_admix puts them, for the results database
+    introgression = sorted(admix, key = lambda x: float(x[0]), reverse=True)
+    events = {}
+    if args.trees != None:
+        # Introgression can only be specified between taxa shared by all trees
+        for label in labels:
+            for e in admix:
+                if e[1] not in species[label][3] or e[2] not in species[label][3]:
+                    sys.exit("Error: with --trees, introgression must be between taxa in every tree")
+            events[label] = hemiplasytool.convert_admix(admix, species[label][3])
+    else:
+        original_tree, tmp = hemiplasytool.names2ints(variants['point'], conversion_type, type)
 
-        admix.sort(key = lambda x: float(x[0]), reverse=True)
+        #Generate tree with internal branches labeled based on user input
+        #plus how ms interprets them. e.g., I4(3). This way I can easily specify the
+        #events to ms.
+        if len(admix) != 0:
+            if outgroup != None:
+                tree2,t2 = hemiplasytool.prune_tree(tree2, derived, outgroup)
+            tree2_ete, tree2_newick, node_conversions = hemiplasytool.make_introgression_tree(tree2, conversions)
 
+            #Update conversion dictionary to contain node conversions (e.g. I4 -> 2)
+            conversions = {**conversions, **node_conversions}
 
+            #Perform conversions on admix list
+            admix = hemiplasytool.convert_admix(admix, conversions)
+        for label in labels:
+            events[label] = admix
 
     # Make program calls
     threads = int(args.threads)
     reps = int(args.replicates)
-
-    breaks = [] #WHAT TO DO WITH THIS?????
-
-
-
-
-
-    # Begin batches
-    taxalist = []
-    for s in traits.keys():
-        taxalist.append(int(s))
-
-    inherited = []
-
-    results = {}
-    n_mutations_d = []
-    n_mutations_c = []
-
-    all_focal_trees = []
-    counts_by_tree = []
-
-    
-
-    total_reps_for_intro = 0
-    if len(admix) != 0:
-        for e in admix:
-            total_reps_for_intro += int(reps * float(e[3]))
-    remaining_reps = reps - total_reps_for_intro
-
-
-    per_thread = remaining_reps//threads
-    v = remaining_reps/threads
-    per_thread = [per_thread]*threads
-    if not v.is_integer():
-        threads += 1
-        per_thread.append(remaining_reps%(threads-1))
-
-
-    if len(admix) != 0:
-        #Extra thread for introgression
-        threads += 1
-
-    prefix = args.outputdir
-
-    processes_ms = []
-    processes_sq = []
-    intro_indices = []
-    if len(admix) == 0:
-        for y in range(0, threads):
-            ms_call = hemiplasytool.splits_to_ms(splits, taxa, per_thread[y], args.mspath, y, prefix)
-            m = hemiplasytool.call_programs(ms_call, "", "trees.tmp", taxalist)
-            processes_ms.append(m)
-    elif len(admix) != 0:
-        for y in range(0, threads):
-            if y != threads-1:
-                ms_call = hemiplasytool.splits_to_ms(splits, taxa, per_thread[y], args.mspath, y, prefix)
-                m = hemiplasytool.call_programs(ms_call, "", "trees.tmp", taxalist)
-                processes_ms.append(m)
-            elif y == threads-1:
-                if (len(admix) != 0):
-                    ms_calls = []
-                    for m, event in enumerate(admix):
-                        o = str(y) + "_" + str(m)
-                        intro_indices.append(m)
-                        ms_call = hemiplasytool.splits_to_ms(splits, taxa, 
-                            int(reps * float(event[3])), args.mspath, o, prefix, event)
-                        m = hemiplasytool.call_programs(ms_call, "", "trees.tmp", taxalist)
-                        processes_ms.append(m)
-                else:
-                    ms_call = hemiplasytool.splits_to_ms(splits, taxa, per_thread[y], args.mspath, y, prefix)
-                    m = hemiplasytool.call_programs(ms_call, "", "trees.tmp", taxalist)
-                    processes_ms.append(m)
-
-    done = False
-    while done == False:
-        ms_processes = []
-        for p in processes_ms:
-            poll = p.poll()
-            if poll == None:
-                ms_processes.append(False)
-            else:
-                ms_processes.append(True)
-    
-        j = all(process == True for process in ms_processes)
-        done = j
-
-
-
-    string_cat_ms = "cat "
-    for y in range(0, threads):
-        if y != threads-1:
-            string_cat_ms += prefix + ".trees" + str(y) + ".tmp "
-        elif y == threads-1:
-            if (len(admix) != 0):
-                for intro in intro_indices:
-                    string_cat_ms += prefix + ".trees" + str(y) + "_" + str(intro) + ".tmp "
-            else:
-                string_cat_ms += prefix + ".trees" + str(y) + ".tmp "
-    string_cat_ms += "> " + prefix + ".trees.tmp"
-    os.system(string_cat_ms)
-
-    for y in range(0, threads):
-        if y != threads-1:
-            seqgencall = hemiplasytool.seq_gen_call(prefix + ".trees" + str(y) + ".tmp", args.seqgenpath, args.mutationrate, str(y), prefix)
-            s = hemiplasytool.call_programs_sg(ms_call, seqgencall, "trees.tmp", taxalist)
-            processes_sq.append(s)
-        else:
-            if (len(admix) != 0):
-                for z, intro in enumerate(intro_indices):
-                    seqgencall = hemiplasytool.seq_gen_call(prefix + ".trees" + str(y) + "_" + str(intro) + ".tmp", args.seqgenpath, args.mutationrate, str(y), prefix, z)
-                    s = hemiplasytool.call_programs_sg(ms_call, seqgencall, "trees.tmp", taxalist)
-                    processes_sq.append(s)
-            else:
-                seqgencall = hemiplasytool.seq_gen_call(prefix + ".trees" + str(y) + ".tmp", args.seqgenpath, args.mutationrate, str(y), prefix)
-                s = hemiplasytool.call_programs_sg(ms_call, seqgencall, "trees.tmp", taxalist)
-                processes_sq.append(s)
-
-
-    intro_start = sum(per_thread)
-
-    done = False
-    while done == False:
-        sg_processes = []
-        for p in processes_sq:
-            poll = p.poll()
-            if poll == None:
-                sg_processes.append(False)
-            else:
-                sg_processes.append(True)
-        j = all(process == True for process in sg_processes)
-        done = j
-
-    string_cat = "cat "
-    for y in range(0, threads):
-        if y != threads-1:
-            string_cat += prefix + ".seqs" + str(y) + ".tmp "
-        elif y == threads-1:
-            if (len(admix) != 0):
-                for z, intro in enumerate(intro_indices):
-                    string_cat += prefix + ".seqs" + str(y) + "_" + str(z) + ".tmp "
-            else:
-                string_cat += prefix + ".seqs" + str(y) + ".tmp "
-
-    string_cat += "> " + prefix + ".seqs.tmp"
-    os.system(string_cat)
-
-
-    # Gets indices of trees with site patterns that match speecies pattern
-    log.debug("Finding trees that match species trait pattern...")
-    match_species_pattern, counts_by_tree = seqtools.readSeqs(
-        prefix + ".seqs.tmp", len(taxalist), traits, len(splits), i, prefix, intro_start
-    )
-
-
-    log.debug("Getting focal trees...")
-    # Gets the trees at these indices 
-    focal_trees, _ = seqtools.getTrees(prefix + ".trees.tmp", match_species_pattern)
-    all_focal_trees = focal_trees
-    assert len(match_species_pattern) == len(focal_trees)
-    log.debug("Calculating discordance...")
-    results[i], disc, conc = seqtools.propDiscordant(focal_trees, treeSp)
-
-    ##The error we're getting wrt introgression not being accurately relfected in mutation counting happens around here \
-    ##Either count_mutations is not working on introgressed trees OR we are passing a list of trees that doesnt contain \
-    ##the introgreesion trees.
-
-
-    focaltrees_d = seqtools.parse_seqgen(prefix + ".focaltrees.tmp", len(taxalist), disc)
-    focaltrees_c = seqtools.parse_seqgen(prefix + ".focaltrees.tmp", len(taxalist), conc)
-    
-    for index, tree in enumerate(focaltrees_d):
-        n_mutations_d.append(seqtools.count_mutations(tree, len(taxalist)))
-    for index, tree in enumerate(focaltrees_c):
-        n_mutations_c.append(seqtools.count_mutations(tree, len(taxalist)))
-    nderived = 0
-    for trait in traits.values():
-        if trait == 1:
-            nderived += 1
-    interesting = seqtools.get_interesting(
-        focaltrees_d, nderived, len(traits.keys())
-    )
-    for item in interesting:
-        test_summarize = seqtools.summarize_interesting(item, len(traits.keys()))
-        inherited = inherited + test_summarize
-
-    # Clean up temporary files
-    #os.system("rm *.tmp")
-    ###################################################################
-
-    # Begin summary of all batches
-    mutation_counts_d = [[x, n_mutations_d.count(x)] for x in set(n_mutations_d)]
-    mutation_counts_c = [[x, n_mutations_c.count(x)] for x in set(n_mutations_c)]
-    summary = hemiplasytool.summarize(results)
-    #counts_by_tree = seqtools.sum_counts_by_tree(counts_by_tree)
-    if len(inherited) > 0:
-        mutation_pat = hemiplasytool.summarize_inherited(inherited)
+    seqtools.set_cache_size(args.topologycache)
+    if args.db != None:
+        from heist import database
+        database.JOURNAL_MODE = args.dbjournal.upper()
+    seed = args.seed
+    if seed == None:
+        seed = random.randint(1, 2147483647)
+    log.debug("Random seed: " + str(seed))
+    if args.cache != None and args.seed == None:
+        # Chunk seeds are part of the cache key, so random seeds never hit
+        sys.stderr.write("Warning: --cache has no effect without --seed, chunks are not cached\n")
+        args.cache = None
+
+    if len(labels) == 1:
+        prefixes = {labels[0]: args.outputdir}
     else:
-        mutation_pat = None
-        log.debug(
-            "Not enough 'interesting' cases to provide mutation inheritance patterns"
-        )
-    min_mutations_required = hemiplasytool.fitchs_alg(str(treeSp), traits)
-
-    if type == "coal":
-        intercept, coef, newick_internals, coal_internals = [None]*4
-
-
-    log.debug("Writing output file...")
-    hemiplasytool.write_output(
-        summary,
-        mutation_counts_c,
-        mutation_counts_d,
-        mutation_pat,
-        counts_by_tree,
-        str(treeSp),
-        admix,
-        traits,
-        min_mutations_required,
-        args.outputdir,
-        (reps),
-        conversions,
-        original_tree[0],
-        intercept,
-        coef,
-        newick_internals,
-        coal_internals,
-        args.mutationrate
-    )
-    hemiplasytool.write_unique_trees(all_focal_trees, args.outputdir, traits)
+        prefixes = {label: args.outputdir + "_" + label for label in labels}
+
+    # Divide replicates among trees. CI variants share chunk seeds, so they
+    # are compared under common random numbers; separate input trees do not.
+    chunks = {}
+    seed_keys = {}
+    for i, label in enumerate(labels):
+        if args.trees != None:
+            tree_reps = reps // len(labels) + (1 if i < reps % len(labels) else 0)
+            chunks[label] = hemiplasytool.split_replicates(tree_reps, max(1, threads // len(labels)), events[label])
+            seed_keys[label] = label + "_"
+        else:
+            chunks[label] = hemiplasytool.split_replicates(reps, threads, events[label])
+            seed_keys[label] = ""
+
+    # All trees are scheduled on one pool. Each chunk's sequences are
+    # scanned as soon as it is simulated, and each tree is analysed once all
+    # its chunks are scanned, while the chunks of the next trees simulate.
+    calls = []
+    scans = []
+    for label in labels:
+        treeV, splits, taxa, tree_conversions, traits = species[label]
+        prefix = prefixes[label]
+        for c in chunks[label]:
+            ms_seeds, sg_seed = hemiplasytool.chunk_seeds(seed, seed_keys[label] + c[0])
+            ms_call = hemiplasytool.splits_to_ms(splits, taxa, c[1], args.mspath, c[0], prefix, c[2], ms_seeds,
+                args.compress)
+            seqgencall = hemiplasytool.seq_gen_call(prefix + ".trees" + c[0] + ".tmp", args.seqgenpath,
+                args.mutationrate, c[0], prefix, seed=sg_seed, compression=args.compress)
+            key = cache.chunk_key(splits, taxa, c[1], c[2], ms_seeds, args.mutationrate, sg_seed, args.compress)
+            files = [prefix + ".trees" + c[0] + ".tmp", prefix + ".seqs" + c[0] + ".tmp"]
+            calls.append([[ms_call, seqgencall], key, files])
+            scans.append(files + [len(traits), traits, len(splits), c[1] if c[2] is None else 0])
+    log.debug("Simulating " + str(len(calls)) + " chunks on " + str(threads) + " threads...")
+    # One pool of analysis processes for the chunk scans and the focal
+    # summaries, started before the simulation threads
+    analyses = seqtools.process_pool(threads)
+    scanned = hemiplasytool.run_pipeline(calls, scans, analyses, threads, args.cache, int(args.cachesize * 1e9))
+
+    stats = []
+    if args.trees != None:
+        pooled_trees = open(args.outputdir + '.trees', 'w')
+    for label in labels:
+        treeSp, splits, taxa, tree_conversions, traits = species[label]
+        prefix = prefixes[label]
+        variant_scans = [next(scanned) for c in chunks[label]]
+        if len(labels) > 1:
+            log.debug("Analysing " + label + "...")
+        if args.trees != None:
+            sink = lambda trees: pooled_trees.write(
+                "".join([hemiplasytool.ints2names(tree, tree_conversions) + '\n' for tree in trees]))
+        else:
+            focal_trees = open(prefix + '.trees', 'w')
+            sink = lambda trees: focal_trees.write("".join([tree + '\n' for tree in trees]))
+        summary, mutation_counts_c, mutation_counts_d, mutation_pat, counts_by_tree, topologies = analyze_variant(
+            prefix, chunks[label], variant_scans, traits, treeSp, events[label], threads, sink, args.records,
+            analyses)
+
+        min_mutations_required = hemiplasytool.fitchs_alg(str(treeSp), traits)
+        run = {"input": args.input, "prefix": prefix, "variant": label,
+               "species_tree": hemiplasytool.ints2names(str(treeSp), tree_conversions),
+               "fitch": min_mutations_required, "events": len(events[label]),
+               "introgression": ";".join([",".join([str(x) for x in e]) for e in introgression]),
+               "replicates": sum([c[1] for c in chunks[label]]), "mutation_rate": float(args.mutationrate),
+               "seed": seed}
+
+        if args.trees != None:
+            stats.append(hemiplasytool.summary_stats(summary, mutation_counts_c, mutation_counts_d,
+                counts_by_tree, min_mutations_required))
+            if args.db != None:
+                hemiplasytool.record_results(args.db, run, stats[-1], mutation_counts_c, mutation_counts_d,
+                    mutation_pat, topologies, traits, tree_conversions)
+            hemiplasytool.cleanup_variant(prefix, chunks[label])
+            continue
+        focal_trees.close()
+
+        log.debug("Writing output file...")
+        stats.append(hemiplasytool.write_output(
+            summary,
+            mutation_counts_c,
+            mutation_counts_d,
+            mutation_pat,
+            counts_by_tree,
+            str(treeSp),
+            events[label],
+            traits,
+            min_mutations_required,
+            prefix,
+            (reps),
+            conversions,
+            original_tree,
+            intercept,
+            coef,
+            newick_internals,
+            coal_internals,
+            args.mutationrate,
+            args.db,
+            run,
+            topologies,
+            tree_conversions
+        ))
+        hemiplasytool.write_unique_trees(topologies, prefix, traits, args.top)
+        hemiplasytool.cleanup_variant(prefix, chunks[label])
+    scanned.close()
+    analyses.shutdown()
+    log.debug(seqtools.cache_summary())
+
+    if args.trees != None:
+        pooled_trees.close()
+    if len(labels) > 1 or args.trees != None:
+        hemiplasytool.write_variant_summary(args.outputdir, labels,
+            [species[label][0] for label in labels], stats, reps, args.mutationrate, seed,
+            pooled = args.trees != None)
     end = time.time()
     print("\nTime elapsed: " + str(end - start) + " seconds")
     ################################################################
@@ -0,0 +1,232 @@
+# /usr/bin/python3
+import os
+import numpy as np
+from collections import OrderedDict
+from heist import seqtools
+
+"""
+Hemiplasy Tool
+Authors: Matt Gibson, Mark Hibbins
+Indiana University
+
+Streaming summary of the focal loci (loci matching the species character
+states). Loci are read in batches from the focal sequence file, the matched
+index file and the gene tree file, and folded into fixed-size histograms and
+a topology counter, so memory depends on the number of taxa and of distinct
+gene tree topologies, not on the number of loci.
+"""
+
+# Approximate bytes of the focal file read per batch
+STREAM_BYTES = 1 << 24
+
+
+class FocalSummary(object):
+    """
+    Running summary of focal loci: mutation count histograms of concordant
+    and discordant loci, per-taxon origins of the derived alleles on
+    "interesting" loci (discordant, more than one but fewer than nderived
+    mutations), and the count and first tree of each gene tree topology.
+    Summaries of consecutive batches are combined with merge.
+    """
+    __slots__ = ("ntaxa", "nderived", "nloci", "ndiscordant", "concordant", "discordant",
+                 "tips", "inherited", "first", "topologies")
+
+    def __init__(self, ntaxa, nderived):
+        self.ntaxa = ntaxa
+        self.nderived = nderived
+        self.nloci = 0
+        self.ndiscordant = 0
+        # Mutations per locus are at most the 2 * ntaxa - 2 branches
+        self.concordant = np.zeros(2 * ntaxa - 1, dtype=np.int64)
+        self.discordant = np.zeros(2 * ntaxa - 1, dtype=np.int64)
+        self.tips = np.zeros(ntaxa, dtype=np.int64)
+        self.inherited = np.zeros(ntaxa, dtype=np.int64)
+        # Position (locus * ntaxa + taxon) where each taxon first appears
+        # derived on an interesting locus, -1 if it has not
+        self.first = np.full(ntaxa, -1, dtype=np.int64)
+        self.topologies = OrderedDict()
+
+    def add(self, trees, keys, discordant, mutations, derived, tip_mutation):
+        """
+        Adds a batch of loci: their gene trees and topologies (keys, from
+        seqtools.cached_topology), discordance flags, and the mutation
+        counts, derived tips and tip mutations of mutation_origins.
+        """
+        n = 2 * self.ntaxa - 1
+        self.concordant += np.bincount(mutations[~discordant], minlength=n)
+        self.discordant += np.bincount(mutations[discordant], minlength=n)
+
+        interesting = discordant & (mutations > 1) & (mutations < self.nderived)
+        derived = derived & interesting[:, None]
+        tip_mutation = tip_mutation & derived
+        self.tips += tip_mutation.sum(axis=0)
+        self.inherited += (derived & ~tip_mutation).sum(axis=0)
+        seen = derived.any(axis=0)
+        first = np.argmax(derived, axis=0) * self.ntaxa + np.arange(self.ntaxa) + self.nloci * self.ntaxa
+        new = seen & (self.first < 0)
+        self.first[new] = first[new]
+
+        for tree, key in zip(trees, keys):
+            if key in self.topologies:
+                self.topologies[key][1] += 1
+            else:
+                self.topologies[key] = [tree, 1]
+        self.nloci += len(mutations)
+        self.ndiscordant += int(np.count_nonzero(discordant))
+
+    def merge(self, other):
+        """Adds the summary of the loci that follow this summary's loci."""
+        self.concordant += other.concordant
+        self.discordant += other.discordant
+        self.tips += other.tips
+        self.inherited += other.inherited
+        new = (other.first >= 0) & (self.first < 0)
+        self.first[new] = other.first[new] + self.nloci * self.ntaxa
+        for key, val in other.topologies.items():
+            if key in self.topologies:
+                self.topologies[key][1] += val[1]
+            else:
+                self.topologies[key] = list(val)
+        self.nloci += other.nloci
+        self.ndiscordant += other.ndiscordant
+
+    def mutation_counts(self, discordant=False):
+        """[[number of mutations, loci]] of the concordant (or discordant) loci, for counts seen."""
+        hist = self.discordant if discordant else self.concordant
+        return [[int(x), int(hist[x])] for x in np.flatnonzero(hist)]
+
+    def origins(self):
+        """
+        {taxon: [tip mutations, inherited]} of the derived alleles on
+        interesting loci, in order of first appearance.
+        """
+        origins = OrderedDict()
+        for taxon in sorted(np.flatnonzero(self.first >= 0), key = lambda t: self.first[t]):
+            origins[str(taxon + 1)] = [int(self.tips[taxon]), int(self.inherited[taxon])]
+        return origins
+
+
+class LocusRecords(object):
+    """
+    Per-locus records of the focal loci, written batch by batch to a
+    directory of .npy arrays that np.load can memory-map (mmap_mode="r"):
+
+    index           1-based index of the locus among the simulated loci
+    origin          0 for the species history, m for the m-th introgression
+                    event
+    topology        gene tree topology, an index into topologies
+    branch_lengths  (loci, 2 * ntaxa - 2) branch lengths, in the postorder
+                    of the topology's branches (root excluded)
+    mutations       number of mutations
+    discordant      True if the gene tree is discordant with the species tree
+    topologies      distinct topologies, as Newick strings without branch
+                    lengths with children ordered by their smallest leaf
+    """
+    __slots__ = ("path", "columns", "topologies", "start")
+
+    def __init__(self, path, nloci, ntaxa):
+        self.path = path
+        self.topologies = OrderedDict()
+        self.start = 0
+        os.makedirs(path, exist_ok=True)
+        columns = [["index", (nloci,), np.int64], ["origin", (nloci,), np.int8],
+                   ["topology", (nloci,), np.int32], ["branch_lengths", (nloci, 2 * ntaxa - 2), np.float64],
+                   ["mutations", (nloci,), np.int32], ["discordant", (nloci,), bool]]
+        self.columns = OrderedDict()
+        for name, shape, dtype in columns:
+            filename = os.path.join(path, name + ".npy")
+            if nloci == 0:
+                np.save(filename, np.zeros(shape, dtype=dtype))
+                self.columns[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self.columns[name] = np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+
+    def add(self, index, breaks, topologies, ids, lengths, mutations, discordant):
+        """
+        Writes the records of the next batch of loci, from their indices,
+        the last index of the species history and of each introgression
+        event (breaks) and canonical_lengths.
+        """
+        end = self.start + len(index)
+        known = np.array([self.topologies.setdefault(t, len(self.topologies)) for t in topologies], dtype=np.int32)
+        self.columns["index"][self.start:end] = index
+        self.columns["origin"][self.start:end] = np.searchsorted(breaks, index)
+        self.columns["topology"][self.start:end] = known[ids]
+        self.columns["branch_lengths"][self.start:end] = lengths
+        self.columns["mutations"][self.start:end] = mutations
+        self.columns["discordant"][self.start:end] = discordant
+        self.start = end
+
+    def close(self):
+        """Flushes the columns and writes the topology dictionary."""
+        for column in self.columns.values():
+            if isinstance(column, np.memmap):
+                column.flush()
+        self.columns = OrderedDict()
+        np.save(os.path.join(self.path, "topologies.npy"), np.array(list(self.topologies), dtype=str))
+
+
+def summarize_batch(trees, labels, states, species_tree, ntaxa, nderived, records=False, cache_size=10000):
+    """
+    Summary of one batch of focal loci; the unit of parallel work. Topology
+    caches hold up to cache_size trees in the process running it. Returns
+    the summary, the topology cache lookups made (seqtools.take_counts)
+    and, with records, the loci's canonical topologies and branch lengths
+    (canonical_lengths), mutation counts and discordance flags.
+    """
+    seqtools.set_cache_size(cache_size)
+    before = seqtools.snapshot_counts()
+    keys = [seqtools.cached_topology(tree) for tree in trees]
+    species = seqtools.topology(species_tree)
+    discordant = np.array([key != species for key in keys], dtype=bool)
+    mutations, derived, tip_mutation = seqtools.mutation_origins(labels, states, ntaxa)[:3]
+    summary = FocalSummary(ntaxa, nderived)
+    summary.add(trees, keys, discordant, mutations, derived, tip_mutation)
+    rows = None
+    if records:
+        rows = seqtools.canonical_lengths(trees, 2 * ntaxa - 2) + (mutations, discordant)
+    return (summary, seqtools.take_counts(before), rows)
+
+
+def focal_batches(treefile, focalfile, matches, species_tree, ntaxa, nderived, sink=None, records=False):
+    """
+    Batches of focal loci for summarize_batch, in focal order: the gene
+    trees at the matched indices (through the tree file's offset index) and
+    the loci's node labels and nucleotide bits. Each batch's trees are
+    passed to sink (if given) as they are read, and this process's
+    topology cache size is passed on to the workers. The tree file is read
+    through one stream, so a compressed file is decompressed once.
+    """
+    start = 0
+    with seqtools.open_intermediate(treefile) as handle:
+        for labels, states in seqtools.iter_states(focalfile, 2 * ntaxa - 1, STREAM_BYTES):
+            trees, _ = seqtools.getTrees(treefile, matches[start:start + len(labels)].tolist(), handle)
+            assert len(trees) == len(labels)
+            start += len(labels)
+            if sink != None:
+                sink(trees)
+            yield [trees, labels, states, species_tree, ntaxa, nderived, records, seqtools.TOPOLOGY_CACHE_SIZE]
+
+
+def summarize_focal(treefile, focalfile, matchfile, species_tree, ntaxa, nderived, threads=1, sink=None,
+                    records=None, breaks=[], pool=None):
+    """
+    Streams the focal loci once and returns their FocalSummary. Batches are
+    summarized on threads processes (of pool, if given), which get the
+    loci's arrays in shared memory, and merged in order. With records, the
+    per-locus records (see LocusRecords) are written to that directory,
+    with breaks the last locus index of the species history and of each
+    introgression event.
+    """
+    summary = FocalSummary(ntaxa, nderived)
+    matches = seqtools.read_array(matchfile)
+    store = LocusRecords(records, len(matches), ntaxa) if records != None else None
+    batches = focal_batches(treefile, focalfile, matches, species_tree, ntaxa, nderived, sink, store != None)
+    for batch, counts, rows in seqtools.ordered_map(summarize_batch, batches, threads, True, pool):
+        seqtools.add_counts(counts)
+        if store != None:
+            store.add(np.asarray(matches[summary.nloci:summary.nloci + batch.nloci]), breaks, *rows)
+        summary.merge(batch)
+    if store != None:
+        store.close()
+    return summary
@@ -0,0 +1,96 @@
+# /usr/bin/python3
+import hashlib
+import logging as log
+import os
+import shutil
+import threading
+
+"""
+Hemiplasy Tool
+Authors: Matt Gibson, Mark Hibbins
+Indiana University
+
+Persistent cache of simulated chunks. Each chunk's ms gene trees and seq-gen
+sequences are stored under a hash of the parameters that produced them, so
+later runs with the same species tree, introgression setup, mutation rate
+and seed reuse them instead of simulating again.
+"""
+
+CACHE_VERSION = "1"
+SUFFIXES = [".trees", ".seqs"]
+
+_lock = threading.Lock()
+
+
+def chunk_key(splits, taxa, reps, admix, ms_seeds, mutationrate, sg_seed, compression=None):
+    """
+    Returns the cache key of a simulation chunk: a hash of the ms splits,
+    introgression event, replicate count, mutation rate and seeds, and the
+    compression of the chunk's files if they are compressed.
+    """
+    params = [CACHE_VERSION, [str(x) for x in splits], [[str(y) for y in x] for x in taxa],
+              str(reps), admix, [str(x) for x in ms_seeds], str(float(mutationrate)), str(sg_seed)]
+    if compression != None:
+        params.append(compression)
+    return hashlib.sha256(repr(params).encode("utf-8")).hexdigest()
+
+
+def entry_paths(cache_dir, key):
+    """Paths of the cached files for a key, in the order of SUFFIXES."""
+    return [os.path.join(cache_dir, key + suffix) for suffix in SUFFIXES]
+
+
+def fetch(cache_dir, key, files):
+    """
+    Copies a cached chunk to files (gene tree file, sequence file). Returns
+    False if the chunk is not cached. Hits are touched for LRU eviction.
+    """
+    paths = entry_paths(cache_dir, key)
+    try:
+        for path, dest in zip(paths, files):
+            shutil.copyfile(path, dest)
+            os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def store(cache_dir, key, files, max_bytes):
+    """
+    Adds a simulated chunk to the cache, then evicts the least recently
+    used chunks until the cache is no larger than max_bytes.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    for path, src in zip(entry_paths(cache_dir, key), files):
+        tmp = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".part"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, path)
+    with _lock:
+        evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir, max_bytes):
+    """Removes least recently used chunks until the cache fits in max_bytes."""
+    entries = {}
+    for name in os.listdir(cache_dir):
+        key, suffix = os.path.splitext(name)
+        if suffix not in SUFFIXES:
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        size, used = entries.get(key, [0, 0])
+        entries[key] = [size + st.st_size, max(used, st.st_mtime)]
+
+    total = sum([e[0] for e in entries.values()])
+    for key in sorted(entries, key = lambda k: entries[k][1]):
+        if total <= max_bytes:
+            break
+        log.debug("Evicting chunk " + key[:12] + " from cache")
+        for path in entry_paths(cache_dir, key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= entries[key][0]
@@ -0,0 +1,125 @@
+# /usr/bin/python3
+import sqlite3
+import time
+
+"""
+Hemiplasy Tool
+Authors: Matt Gibson, Mark Hibbins
+Indiana University
+
+SQLite store of run results (--db). Each run adds a row to runs, and its
+summary counts, mutation count histogram, per-taxon mutation origins and
+gene tree topology frequencies to the other tables, in one transaction.
+Runs can append to the same database file concurrently; taxa and
+topologies are stored by name, so runs can be compared in SQL.
+"""
+
+# SQLite journal mode (--dbjournal). The write-ahead log lets queries run
+# while runs are added, but needs shared memory between the processes using
+# the file, so it does not work on network filesystems such as NFS; DELETE
+# (SQLite's default) does.
+JOURNAL_MODE = "WAL"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created REAL,
+    input TEXT,
+    prefix TEXT,
+    variant TEXT,
+    species_tree TEXT,
+    derived TEXT,
+    fitch INTEGER,
+    events INTEGER,
+    introgression TEXT,
+    replicates INTEGER,
+    mutation_rate REAL,
+    seed INTEGER
+);
+CREATE TABLE IF NOT EXISTS summary (
+    run_id INTEGER PRIMARY KEY REFERENCES runs (id),
+    matched INTEGER,
+    true_hemiplasy INTEGER,
+    mixed INTEGER,
+    true_homoplasy INTEGER,
+    discordant INTEGER,
+    concordant INTEGER,
+    introgressed INTEGER,
+    species INTEGER
+);
+CREATE TABLE IF NOT EXISTS mutations (
+    run_id INTEGER REFERENCES runs (id),
+    mutations INTEGER,
+    concordant INTEGER,
+    discordant INTEGER,
+    PRIMARY KEY (run_id, mutations)
+);
+CREATE TABLE IF NOT EXISTS origins (
+    run_id INTEGER REFERENCES runs (id),
+    taxon TEXT,
+    tip INTEGER,
+    internal INTEGER,
+    reversal INTEGER,
+    PRIMARY KEY (run_id, taxon)
+);
+CREATE TABLE IF NOT EXISTS topologies (
+    run_id INTEGER REFERENCES runs (id),
+    topology TEXT,
+    count INTEGER,
+    PRIMARY KEY (run_id, topology)
+);
+CREATE INDEX IF NOT EXISTS runs_derived ON runs (derived);
+CREATE INDEX IF NOT EXISTS runs_species_tree ON runs (species_tree);
+CREATE INDEX IF NOT EXISTS runs_events ON runs (events);
+CREATE INDEX IF NOT EXISTS summary_hemiplasy ON summary (true_hemiplasy, matched);
+CREATE INDEX IF NOT EXISTS origins_taxon ON origins (taxon);
+CREATE INDEX IF NOT EXISTS topologies_topology ON topologies (topology);
+"""
+
+# Columns of the summary table, in the order of summary_stats
+SUMMARY = ["matched", "true_hemiplasy", "mixed", "true_homoplasy", "discordant", "concordant",
+           "introgressed", "species"]
+
+
+def connect(path, timeout=600):
+    """
+    Opens the database at path, creating the tables if needed, in
+    JOURNAL_MODE. Writers wait up to timeout seconds for each other.
+    """
+    db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    db.execute("PRAGMA journal_mode=" + JOURNAL_MODE)
+    db.executescript(SCHEMA)
+    return db
+
+
+def record_run(path, run, stats, histogram, origins, topologies):
+    """
+    Adds a run to the database at path. run maps runs columns to values,
+    stats holds the counts of summary_stats, histogram maps a number of
+    mutations to [concordant, discordant] loci, origins holds [taxon, tip,
+    internal, reversal] rows and topologies maps a topology to its count.
+    Returns the run's id.
+    """
+    run = dict(run, created=time.time())
+    db = connect(path)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        columns = list(run.keys())
+        run_id = db.execute("INSERT INTO runs (" + ", ".join(columns) + ") VALUES (" +
+                            ", ".join(["?"] * len(columns)) + ")", [run[c] for c in columns]).lastrowid
+        db.execute("INSERT INTO summary (run_id, " + ", ".join(SUMMARY) + ") VALUES (" +
+                   ", ".join(["?"] * (len(SUMMARY) + 1)) + ")", [run_id] + [int(x) for x in stats])
+        db.executemany("INSERT INTO mutations VALUES (?, ?, ?, ?)",
+                       [(run_id, int(k), int(v[0]), int(v[1])) for k, v in histogram.items()])
+        db.executemany("INSERT INTO origins VALUES (?, ?, ?, ?, ?)",
+                       [(run_id, row[0], int(row[1]), int(row[2]), int(row[3])) for row in origins])
+        db.executemany("INSERT INTO topologies VALUES (?, ?, ?)",
+                       [(run_id, k, int(v)) for k, v in topologies.items()])
+        db.execute("COMMIT")
+    except BaseException:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        raise
+    finally:
+        db.close()
+    return run_id
@@ -0,0 +1,80 @@
+# /usr/bin/python3
+import sys
+import numpy as np
+from heist import seqtools
+
+"""
+Hemiplasy Tool
+Authors: Matt Gibson, Mark Hibbins
+Indiana University
+
+Fitch parsimony over bitmask state sets. Trees are flattened into arrays of
+internal nodes in postorder, so many character patterns on many trees are
+scored together, one internal node at a time.
+"""
+
+
+def postorder(newick, taxa):
+    """
+    Internal nodes of a bifurcating Newick tree in postorder. Leaves are
+    nodes 0..n-1 in the order of taxa, and internal node k is node n+k, with
+    children left[k] and right[k]. A root with three children (an unrooted
+    tree) is resolved, which leaves parsimony scores unchanged.
+    """
+    index = {name: i for i, name in enumerate(taxa)}
+    left = []
+    right = []
+    stack = [[]]
+    leaf = True
+    for token in seqtools.TOKEN.findall(newick):
+        if token == "(":
+            stack.append([])
+            leaf = True
+        elif token == ",":
+            leaf = True
+        elif token == ")":
+            kids = stack.pop()
+            if len(kids) == 3 and len(stack) == 1:
+                left.append(kids[0])
+                right.append(kids[1])
+                kids = [len(taxa) + len(left) - 1, kids[2]]
+            if len(kids) != 2:
+                sys.exit("Error: Fitch parsimony requires a bifurcating tree: " + newick)
+            left.append(kids[0])
+            right.append(kids[1])
+            stack[-1].append(len(taxa) + len(left) - 1)
+            leaf = False
+        elif token[0] != ":" and leaf:
+            if token not in index:
+                sys.exit("Error: taxon " + token + " of tree " + newick + " has no character state")
+            stack[-1].append(index[token])
+    if len(left) != len(taxa) - 1:
+        sys.exit("Error: tree " + newick + " does not have the same taxa as the character pattern")
+    return (np.array(left, dtype=np.int64), np.array(right, dtype=np.int64))
+
+
+def fitch_scores(trees, patterns, taxa):
+    """
+    Fitch parsimony scores of character patterns on trees. patterns has one
+    row of integer states (0-7) per pattern, in the order of taxa, which are
+    the leaves of every tree. Returns a (trees, patterns) array of the
+    minimum number of changes.
+    """
+    n = len(taxa)
+    patterns = np.asarray(patterns, dtype=np.int64).reshape(-1, n)
+    nodes = [postorder(tree, taxa) for tree in trees]
+    left = np.array([x[0] for x in nodes], dtype=np.int64).reshape(len(trees), n - 1)
+    right = np.array([x[1] for x in nodes], dtype=np.int64).reshape(len(trees), n - 1)
+
+    rows = np.arange(len(trees))
+    sets = np.zeros((len(trees), 2 * n - 1, patterns.shape[0]), dtype=np.uint8)
+    sets[:, :n, :] = np.left_shift(1, patterns.T).astype(np.uint8)
+    scores = np.zeros((len(trees), patterns.shape[0]), dtype=np.int64)
+    for k in range(n - 1):
+        a = sets[rows, left[:, k]]
+        b = sets[rows, right[:, k]]
+        both = a & b
+        empty = both == 0
+        sets[:, n + k] = np.where(empty, a | b, both)
+        scores += empty
+    return scores
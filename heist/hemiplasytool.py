@@ -1,95 +1,170 @@
 # /usr/bin/python3
-import matplotlib.pyplot as plt
-import numpy as np
-import numpy.polynomial.polynomial as poly
 import logging as log
 import os
+import sys
 import io
 import re
-import math
 import shlex
-import atexit
-from Bio import Phylo
-from Bio.Alphabet import generic_dna
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
-from Bio.Align import MultipleSeqAlignment
-from Bio.Phylo.TreeConstruction import ParsimonyScorer
-from heist import seqtools
-from ete3 import Tree
+import random
+import heapq
+import shutil
+from heist import cache
+from heist.tree import Tree
 from collections import OrderedDict
 from subprocess import Popen, PIPE
-import copy
+from concurrent.futures import ThreadPoolExecutor
 
 """
 Hemiplasy Tool
 Authors: Matt Gibson, Mark Hibbins
 Indiana University
-"""
-
-def names2ints(newick, conversion_type, type):
-    t = Tree(newick, format = 1)
-    ntaxa = 0
-    for n1 in t.iter_leaves():
-        ntaxa += 1
 
-    i = 0
-
-    rankings = {}
+NumPy, matplotlib and the seqtools/fitch modules are imported by the
+functions that use them, so that newick2ms, subs2coal and heistMerge start
+without loading them.
+"""
 
-    for n1 in t.iter_leaves():
-        n_ancestors = len(n1.get_ancestors())
-        rankings[n1.name] = n_ancestors
+# Shell commands that compress standard input, and decompress a file, to
+# standard output for each choice of --compress
+COMPRESSORS = {"gzip": ("gzip -c -1", "gzip -dc"), "zstd": ("zstd -q -c -1", "zstd -q -dc")}
 
-    s = [(k, rankings[k]) for k in sorted(rankings, key=rankings.get, reverse=False)]
+def names2ints(newick, conversion_type, type):
+    """
+    Relabels the taxa of a species tree (a Newick string or Tree, which is
+    modified) as ms integers, shallowest taxa first, and converts it to an
+    ultrametric tree unless it is already in coalescent units. Returns the
+    tree as a Newick string and the conversions.
+    """
+    if isinstance(newick, Tree):
+        t = newick
+    else:
+        t = Tree(newick)
 
-    int_names = [i for i in range(1, len(s)+1)]
     rankings = {}
+    for n1 in t.leaves():
+        rankings[t.names[n1]] = t.depth(n1)
+    s = [k for k in sorted(rankings, key=rankings.get, reverse=False)]
+    rankings = {name: i + 1 for i, name in enumerate(s)}
+    t.relabel(rankings)
 
-    for i, item in enumerate(s):
-        name = item[0]
-        new = int_names[i]
-        newick = newick.replace(name, str(new))
-        rankings[name] = new
-    newick = Tree(newick, format = 1)
     if type != 'coal':
-        if conversion_type == 'ete3':
-            newick.convert_to_ultrametric()
-        elif conversion_type == 'extend':
-            newick = convert_to_ultrametric_extend(newick)
+        if conversion_type == 'extend':
+            t.extend_ultrametric()
         else:
-            newick.convert_to_ultrametric() #else do ete3
-    return(newick.write(), rankings)
+            t.to_ultrametric() #else balanced conversion, as in ete3
+    return(t.write(), rankings)
 
-def convert_to_ultrametric_extend(tree):
-
-    most_dist, tree_length = tree.get_farthest_leaf()
-
-    for leaf in tree:
-        d = leaf.get_distance(tree)
-        leaf.dist += (tree_length-d)
-    return(tree)
+def ints2names(newick, conversions):
+    """Replaces ms integer codes in a newick string with taxon names."""
+    names = {str(val): key for key, val in conversions.items()}
+    return re.sub(r"([(,])(\d+)(?=[:,)])", lambda m: m.group(1) + names.get(m.group(2), m.group(2)), newick)
 
 def newick2ms(newick):
     """
-    Converts a Newick tree with branch lengths in coalscent units to ms-style splits
+    Converts a Newick tree with branch lengths in coalscent units to ms-style
+    splits. Taxa are joined closest pair first, the larger ms label into the
+    smaller, at a quarter of the distance between them; ties go to the pair
+    that comes first in preorder. When only sister leaves can be closest
+    (see cherries_join_first), candidate pairs are kept in a heap, so each
+    join is found without recomputing the distances between all taxa.
     """
-    t = Tree(newick, format=1)
+    t = Tree(newick)
+    if not cherries_join_first(t):
+        return pairwise_splits(t)
+
+    # Sister leaf pairs by distance
+    heap = []
+    for n in t.preorder():
+        kids = [c for c in t.children[n] if t.is_leaf(c)]
+        for i, a in enumerate(kids):
+            for b in kids[i + 1:]:
+                heapq.heappush(heap, (t.dists[a] + t.dists[b], a, b))
 
-    ntaxa = 0
-    for n1 in t.iter_leaves():
-        ntaxa += 1
+    ms_splits = []
+    ms_taxa = []
+    while heap:
+        # Pairs that are no longer sisters were broken up by earlier joins
+        d = heap[0][0]
+        tied = []
+        while heap and heap[0][0] == d:
+            pair = heapq.heappop(heap)
+            if t.parent[pair[1]] != -1 and t.parent[pair[1]] == t.parent[pair[2]]:
+                tied.append(pair)
+        if len(tied) == 0:
+            continue
+        keys = []
+        for pair in tied:
+            positions = sorted([preorder_key(t, pair[1]), preorder_key(t, pair[2])])
+            keys.append(positions)
+        first = keys.index(min(keys))
+        for i, pair in enumerate(tied):
+            if i != first:
+                heapq.heappush(heap, pair)
+
+        a, b = tied[first][1], tied[first][2]
+        taxa_to_collapse = [int(t.names[a]), int(t.names[b])]
+        ms_splits.append((d/2)/2)
+        ms_taxa.append([max(taxa_to_collapse), min(taxa_to_collapse)])
+
+        # The larger label is removed; if that leaves its parent with a
+        # single child, the survivor moves up and gains new sisters
+        keep, drop = (a, b) if taxa_to_collapse[0] < taxa_to_collapse[1] else (b, a)
+        parent = t.parent[drop]
+        t.delete(drop, preserve_branch_length=True)
+        if t.parent[keep] != parent:
+            for c in t.children[t.parent[keep]]:
+                if c != keep and t.is_leaf(c):
+                    heapq.heappush(heap, (t.dists[keep] + t.dists[c], keep, c))
+    return(ms_splits, ms_taxa)
+
+
+def cherries_join_first(t):
+    """
+    True if the closest pair of taxa is a pair of sister leaves at every
+    step of newick2ms: no node has a single child, and every internal branch
+    is longer than the spread of root-to-tip distances (as in ultrametric
+    trees).
+    """
+    depth = {t.root: 0.0}
+    for n in t.preorder():
+        for c in t.children[n]:
+            depth[c] = depth[n] + t.dists[c]
+    tips = [depth[n] for n in t.leaves()]
+    spread = max(tips) - min(tips) + 1e-9 * max([abs(x) for x in tips])
+    for n in t.preorder():
+        if t.is_leaf(n):
+            continue
+        if len(t.children[n]) < 2 or (n != t.root and t.dists[n] <= spread):
+            return False
+    return True
+
+
+def preorder_key(t, node):
+    """Child indices on the path from the root to node; sorts nodes in preorder."""
+    key = []
+    while t.parent[node] != -1:
+        key.append(t.children[t.parent[node]].index(node))
+        node = t.parent[node]
+    return key[::-1]
+
+
+def pairwise_splits(t):
+    """
+    newick2ms by comparing the distances between all pairs of taxa at every
+    join. Used for trees where the closest taxa need not be sisters.
+    """
+    ntaxa = len(t.leaves())
     i = 0
     ms_splits = []
     ms_taxa = []
     while i < ntaxa+1:
         distances = []
         taxa = []
-        for n1 in t.iter_leaves():
-            for n2 in t.iter_leaves():
-                n1n = n1.name
-                n2n = n2.name
-                d = n1.get_distance(n2)
+        for n1 in t.leaves():
+            for n2 in t.leaves():
+                n1n = t.names[n1]
+                n2n = t.names[n2]
+                d = t.distance(n1, n2)
                 if n1n != n2n:
                     distances.append(d)
                     taxa.append(n1n + ' ' + n2n)
@@ -104,17 +179,17 @@ def newick2ms(newick):
         ms_splits.append((minDistance/2)/2)
         ms_taxa.append([max(taxa_to_collapse), min(taxa_to_collapse)])
 
-        for node1 in t.iter_leaves():
-            if node1.name == str(max(taxa_to_collapse)):
-                node1.delete(preserve_branch_length=True)
+        for node1 in t.leaves():
+            if t.names[node1] == str(max(taxa_to_collapse)):
+                t.delete(node1, preserve_branch_length=True)
         i += 1
     return(ms_splits, ms_taxa)
 
 
-def splits_to_ms(splitTimes, taxa, reps, path_to_ms, y, prefix, admix=None):
+def splits_to_ms(splitTimes, taxa, reps, path_to_ms, y, prefix, admix=None, seeds=None, compression=None):
     """
-    Converts inputs into a call to ms
-
+    Converts inputs into a call to ms. With compression ("gzip" or "zstd"),
+    the gene tree file is compressed as ms writes it.
     """
     nsamples = len(splitTimes) + 1
     call = (
@@ -141,21 +216,258 @@ def splits_to_ms(splitTimes, taxa, reps, path_to_ms, y, prefix, admix=None):
             + admix[1]
         )
 
-    if admix is not None:
-        call += " | tail -n +4 | grep -v // > " + prefix + ".trees" + str(y) + ".tmp"
-    else:
-        call += " | tail -n +4 | grep -v // > " + prefix + ".trees" + str(y) + ".tmp"
+    if seeds is not None:
+        call += " -seeds " + " ".join([str(x) for x in seeds])
+
+    call += " | tail -n +4 | grep -v //"
+    if compression is not None:
+        call += " | " + COMPRESSORS[compression][0]
+    call += " > " + prefix + ".trees" + str(y) + ".tmp"
     return call
 
 
-def seq_gen_call(treefile, path, s, i, prefix, z = None):
+def seq_gen_call(treefile, path, s, i, prefix, z = None, seed = None, compression = None):
     """
-    Make seq-gen call.
+    Make seq-gen call. With compression ("gzip" or "zstd"), the gene tree
+    file is decompressed into seq-gen and its output compressed.
     """
+    flags = " -m HKY -l 1 -s " + str(s)
+    if seed is not None:
+        flags += " -z " + str(seed)
+    if compression is None:
+        call = path + flags + ' -wa <"' + treefile + '"'
+    else:
+        call = COMPRESSORS[compression][1] + ' "' + treefile + '" | ' + path + flags + ' -wa | ' + COMPRESSORS[compression][0]
     if z == None:
-        return path + " -m HKY -l 1 -s " + str(s) + ' -wa <"' + treefile + '" > ' + prefix + '.seqs' + str(i) + '.tmp'
+        return call + ' > ' + prefix + '.seqs' + str(i) + '.tmp'
+    else:
+        return call + ' > ' + prefix + '.seqs' + str(i) + '_' + str(z) + '.tmp'
+
+
+def split_replicates(reps, threads, admix):
+    """
+    Divides the replicates into simulation chunks, one per thread plus a
+    remainder chunk, followed by one chunk per introgression event.
+    Returns a list of [label, replicates, event] entries.
+    """
+    intro_reps = [int(reps * float(e[3])) for e in admix]
+    remaining_reps = reps - sum(intro_reps)
+
+    per_thread = [remaining_reps // threads] * threads
+    if remaining_reps % threads != 0:
+        per_thread.append(remaining_reps % threads)
+
+    chunks = [[str(y), n, None] for y, n in enumerate(per_thread)]
+    for m, event in enumerate(admix):
+        chunks.append([str(len(per_thread)) + "_" + str(m), intro_reps[m], event])
+    return [c for c in chunks if c[1] > 0]
+
+
+def history_breaks(chunks, admix):
+    """
+    Last replicate index of each history in the chunks of split_replicates:
+    the species history, then each introgression event of admix in order.
+    """
+    breaks = [sum([c[1] for c in chunks if c[2] is None])]
+    for event in admix:
+        breaks.append(breaks[-1] + sum([c[1] for c in chunks if c[2] is event]))
+    return breaks
+
+
+def chunk_seeds(seed, label):
+    """
+    Derives the ms seeds and seq-gen seed for a simulation chunk from the
+    run seed. A chunk label gets the same seeds in every species tree
+    variant, so variants are compared under common random numbers.
+    """
+    rng = random.Random(str(seed) + ":" + str(label))
+    ms_seeds = [rng.randint(1, 65535) for _ in range(3)]
+    return (ms_seeds, rng.randint(1, 2147483647))
+
+
+def run_command(command):
+    """
+    Runs a shell command and returns its exit status. Under bash (when
+    available) the command runs with pipefail, so a failing program
+    anywhere in a pipeline (e.g. ms) fails the command.
+    """
+    bash = shutil.which("bash")
+    if bash != None:
+        return Popen([bash, "-o", "pipefail", "-c", command]).wait()
+    return Popen(command, shell = True).wait()
+
+
+def simulate_chunk(call, cache_dir=None, cache_size=None):
+    """
+    Runs one simulation chunk, [commands, key, files] as in run_chunks, or
+    copies it from the cache. Exits if a command fails or leaves an output
+    file empty, so a broken chunk is neither analysed nor cached.
+    """
+    from heist import seqtools
+    commands, key, files = call
+    if cache_dir != None and cache.fetch(cache_dir, key, files):
+        log.debug("Reusing cached chunk " + key[:12])
+        return
+    for command in commands:
+        log.debug("Calling " + command.split()[0] + "...")
+        status = run_command(command)
+        if status != 0:
+            sys.exit("Error: simulation command exited with status " + str(status) + ": " + command)
+    for name in files:
+        with seqtools.open_intermediate(name) as f:
+            if not f.read(1):
+                sys.exit("Error: simulation produced an empty file: " + name)
+    if cache_dir != None:
+        cache.store(cache_dir, key, files, cache_size)
+
+
+def run_chunks(calls, threads, cache_dir=None, cache_size=None):
+    """
+    Runs simulation chunks on a shared pool of workers. Each entry in calls
+    is [commands, key, files]: the shell commands run in order (e.g. ms then
+    seq-gen), the chunk's cache key and the gene tree and sequence files it
+    writes. With a cache directory, cached chunks are copied into place
+    instead of simulated, and new chunks are added to the cache.
+    """
+    with ThreadPoolExecutor(max_workers = threads) as pool:
+        list(pool.map(lambda call: simulate_chunk(call, cache_dir, cache_size), calls))
+
+
+def scan_chunk(treefile, seqfile, ntaxa, traits, nodes, breaks):
+    """
+    First analysis stage of a simulated chunk: writes the offsets of its
+    gene trees to the tree file's index (seqtools.tree_index, see
+    index_trees), and its loci matching the trait pattern, and their
+    indices within the chunk, next to its sequence file (seqtools.readSeqs,
+    with prefix the sequence file's name without .tmp). Returns the number
+    of trees, the tree file's length, the number of matches and their
+    numbers from before and after breaks.
+    """
+    from heist import seqtools
+    with open(seqtools.tree_index(treefile), "wb") as index:
+        ntrees, length = index_trees(treefile, index)
+    nmatch, counts = seqtools.readSeqs(seqfile, ntaxa, traits, nodes, 0, seqfile[:-len(".tmp")], breaks)
+    return [ntrees, length, nmatch, counts]
+
+
+def relay(source, target):
+    """Passes the result or exception of a finished future on to another."""
+    if source.exception() != None:
+        target.set_exception(source.exception())
     else:
-        return path + " -m HKY -l 1 -s " + str(s) + ' -wa <"' + treefile + '" > ' + prefix + '.seqs' + str(i) + '_' + str(z) + '.tmp'
+        target.set_result(source.result())
+
+
+def run_pipeline(calls, scans, analyses, threads, cache_dir=None, cache_size=None):
+    """
+    run_chunks with the chunks' first analysis stage overlapped: as soon as
+    a chunk is simulated, scan_chunk is run on it (with the arguments in
+    scans) on the process pool analyses, while the other chunks are still
+    simulating. Yields the scan results in the order of calls, as they are
+    ready; chunks keep being simulated and scanned while the caller works
+    on the results so far. analyses must have started all its workers
+    (seqtools.process_pool), as the simulation threads are running when
+    jobs are submitted to it; it is left running for the caller's use.
+    """
+    from concurrent.futures import Future
+    simulations = ThreadPoolExecutor(max_workers = threads)
+
+    def simulated(future, scan, result):
+        if future.exception() != None:
+            result.set_exception(future.exception())
+        else:
+            analyses.submit(scan_chunk, *scan).add_done_callback(lambda f: relay(f, result))
+
+    try:
+        results = []
+        for call, scan in zip(calls, scans):
+            result = Future()
+            simulations.submit(simulate_chunk, call, cache_dir, cache_size).add_done_callback(
+                lambda f, scan=scan, result=result: simulated(f, scan, result))
+            results.append(result)
+        for result in results:
+            yield result.result()
+    finally:
+        simulations.shutdown(cancel_futures = True)
+
+
+def cat_files(files, outfile, append=False, block=1 << 24):
+    """
+    Concatenates files in order into outfile, or to the end of it with
+    append, streaming them without the shell. Compressed files concatenate
+    into one compressed stream.
+    """
+    with open(outfile, "ab" if append else "wb") as out:
+        for name in files:
+            with open(name, "rb") as f:
+                shutil.copyfileobj(f, out, block)
+
+
+def index_trees(treefile, index=None, shift=0, block=1 << 26, out=None):
+    """
+    Number of trees (lines longer than 3 characters) in a gene tree file and
+    its length, once decompressed. With index, an open binary file, the
+    byte offset of each tree plus shift is appended to it as int64, a block
+    at a time. With out, the decompressed file is also copied to it.
+    """
+    import numpy as np
+    from heist import seqtools
+    ntrees, start, linelen, base = 0, 0, 0, 0
+    with seqtools.open_intermediate(treefile) as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            if out != None:
+                out.write(data)
+            found, start, linelen = seqtools.index_lines(data, start, linelen, base)
+            if index != None:
+                (found + shift).astype(np.int64).tofile(index)
+            ntrees += len(found)
+            base += len(data)
+    if linelen > 3:
+        if index != None:
+            np.array([start + shift], dtype=np.int64).tofile(index)
+        ntrees += 1
+    return (ntrees, base)
+
+
+def cat_trees(files, outfile, lengths=None, block=1 << 26):
+    """
+    Concatenates gene tree files in order into outfile, writing the byte
+    offset of each tree to the offset index used by seqtools.getTrees as
+    the files are read. Compressed files are copied as they are, and
+    indexed by their offsets once decompressed. With lengths, the files'
+    decompressed lengths, their own indexes (written by index_trees) are
+    merged instead, a block at a time. Returns the number of trees in each
+    file.
+    """
+    import numpy as np
+    from heist import seqtools
+    ntrees = []
+    base = 0
+    with open(outfile, "wb") as out, open(seqtools.tree_index(outfile), "wb") as index:
+        for i, name in enumerate(files):
+            if lengths != None:
+                count = 0
+                with open(seqtools.tree_index(name), "rb") as f:
+                    while True:
+                        offsets = np.fromfile(f, dtype=np.int64, count=block // 8)
+                        if len(offsets) == 0:
+                            break
+                        (offsets + base).tofile(index)
+                        count += len(offsets)
+                length = lengths[i]
+            elif seqtools.compression(name) == None:
+                count, length = index_trees(name, index, base, block, out)
+            else:
+                count, length = index_trees(name, index, base, block)
+            if lengths != None or seqtools.compression(name) != None:
+                with open(name, "rb") as f:
+                    shutil.copyfileobj(f, out, block)
+            ntrees.append(count)
+            base += length
+    return ntrees
 
 def print_banner():
     print(" _   _      ___ ____ _____ ")
@@ -209,11 +521,28 @@ def cleanup():
     os.system("rm seqs.tmp")
     os.system("rm focaltrees.tmp")
 
-@atexit.register
 def cleanup_earlyexit():
     """Remove gene trees and sequences files. For use between batches."""
-    os.system("rm *.trees*.tmp")
-    os.system("rm *.seqs*.tmp")
+    os.system("rm -f *.trees*.tmp")
+    os.system("rm -f *.seqs*.tmp")
+
+
+def cleanup_variant(prefix, chunks):
+    """
+    Removes the intermediate files of one species tree variant (its chunks'
+    gene trees, sequences and scans, and the concatenated files), once its
+    results are written.
+    """
+    names = [prefix + x for x in [".trees.tmp", ".trees.idx.tmp", ".trees.match.tmp", ".focaltrees.tmp"]]
+    for c in chunks:
+        names += [prefix + ".trees" + c[0] + ".tmp", prefix + ".trees" + c[0] + ".idx.tmp",
+                  prefix + ".seqs" + c[0] + ".tmp", prefix + ".seqs" + c[0] + ".focaltrees.tmp",
+                  prefix + ".seqs" + c[0] + ".trees.match.tmp"]
+    for name in names:
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
 
 
 def summarize(results):
@@ -234,32 +563,15 @@ def add_branch_lengths(tree, const=1):
     return newTree
 
 
-def get_min_mutations(tree, traitpattern):
+def fitchs_alg(tree, traits):
     """
     Gets the minimum number of mutations required
     to explain the trait pattern without hemiplasy;
-    ie. the parsimony score. Takes a newick tree 
-    and trait pattern in alignment form
+    ie. the parsimony score.
     """
-    scorer = ParsimonyScorer()
-
-    return scorer.get_score(tree, traitpattern)
-
-
-def fitchs_alg(tree, traits):
-    #tree = add_branch_lengths(tree)
-    tree = Phylo.read(io.StringIO(tree), "newick")
-
-    records = []
-    for key, val in traits.items():
-        if val == 0:
-            records.append(SeqRecord(Seq("A", generic_dna), id=str(key)))
-        elif val == 1:
-            records.append(SeqRecord(Seq("T", generic_dna), id=str(key)))
-
-    test_pattern = MultipleSeqAlignment(records)
-
-    return get_min_mutations(tree, test_pattern)
+    from heist import fitch
+    taxa = [str(key) for key in traits.keys()]
+    return int(fitch.fitch_scores([tree], [list(traits.values())], taxa)[0, 0])
 
 
 def write_output(
@@ -280,7 +592,16 @@ def write_output(
     coef,
     newick_internals,
     coal_internals,
-    mutationrate):
+    mutationrate,
+    db=None,
+    run=None,
+    topologies=None,
+    taxa=None):
+    """
+    Writes the report (filename.txt) and raw counts (filename_raw.txt) of a
+    run, and returns its summary_stats. With db, the results are also added
+    to that SQLite database (see record_results).
+    """
     out1 = open(filename+'.txt', "w")
     out2 = open(filename+'_raw.txt', "w")
 
@@ -293,23 +614,8 @@ def write_output(
             derived.append(str(key))
             tree = re.sub(r"\b%s\b" % str(key)+":", str(key) + "*:", tree)
             #tree = tree.replace(str(key)+":", (str(key) + "*:"))
-    if min_mutations_required != 2:
-        mix_range = list(range(2, min_mutations_required))
-    else:
-        mix_range = [0]
-    true_hemi = 0
-    mix = 0
-    true_homo = 0
-    for item in mutation_counts_d:
-        if item[0] == 1:
-            true_hemi = item[1]
-        elif item[0] in mix_range:
-            mix += item[1]
-        elif item[0] >= min_mutations_required:
-            true_homo += item[1]
-    for item in mutation_counts_c:
-        if item[0] >= min_mutations_required:
-            true_homo += item[1]
+    stats = summary_stats(summary, mutation_counts_c, mutation_counts_d, counts, min_mutations_required)
+    true_hemi, mix, true_homo = stats[1:4]
 
     sum_from_introgression = counts[1]
     sum_from_species = counts[0]
@@ -364,9 +670,7 @@ def write_output(
         out1.write("X (newick internals): " + ",".join(newick_internals) + '\n')
         out1.write("Y (coalescent internals): " + ",".join(coal_internals) + '\n')
 
-    t = tree.replace(";", "")
-    t = Phylo.read(io.StringIO(t), "newick")
-    Phylo.draw_ascii(t, out1, column_width=40)
+    Tree(tree).draw_ascii(out1, column_width=40)
 
     # INPUT SUMMARY
     out1.write(
@@ -453,6 +757,7 @@ def write_output(
     out2.write(str(sum_from_species) + '\n') #8#
     
     out2.write(str(mutationrate) + "\n") #9#
+    out2.write("Replicates," + str(reps) + "\n") #10#
 
     # DETAILED OUTPUT
     out1.write('Distribution of mutation counts:\n\n')
@@ -479,24 +784,264 @@ def write_output(
             "\nOrigins of mutations leading to observed character states for hemiplasy + homoplasy cases:\n\n"
         )
         out1.write("\tTip mutation\tInternal branch mutation\tTip reversal\n")
-        for key, val in reduced.items():
-            val = [str(v) for v in val]
-            if key in derived:
-                out1.write("Taxa " + key + "\t" + "\t".join(val) + "\t" + "0" + "\n")
-                out2.write("Taxa " + key + "," + ",".join(val) + "," + "0" + "\n")
-            else:
-                out1.write("Taxa " + key + "\t" + "\t".join(["0", val[1]]) + "\t" + val[0] + "\n")
-                out2.write("Taxa " + key + "," + ",".join(["0", val[1]]) + "," + val[0] + "\n")
+        for row in origin_rows(reduced, derived):
+            row = [str(v) for v in row]
+            out1.write("Taxa " + row[0] + "\t" + "\t".join(row[1:]) + "\n")
+            out2.write("Taxa " + row[0] + "," + ",".join(row[1:]) + "\n")
 
 
     out1.close()
     out2.close()
 
+    if db != None:
+        record_results(db, run, stats, mutation_counts_c, mutation_counts_d, reduced, topologies, traits, taxa)
+    return stats
+
+
+def origin_rows(reduced, derived):
+    """
+    Rows of the mutation origins table, [taxon, tip mutations, internal
+    branch mutations, tip reversals], from the origins of the derived
+    alleles ({taxon: [tip mutations, inherited]}). An ancestral taxon with
+    a derived allele from its own branch had a reversal.
+    """
+    rows = []
+    for key, val in reduced.items():
+        if key in derived:
+            rows.append([key, val[0], val[1], 0])
+        else:
+            rows.append([key, 0, val[1], val[0]])
+    return rows
+
+
+def record_results(db, run, stats, mutation_counts_c, mutation_counts_d, reduced, topologies, traits, taxa):
+    """
+    Adds a run's results to the SQLite database db: the run parameters in
+    run (runs columns), its summary_stats, mutation counts, origins and
+    gene tree topologies ({topology: [first tree, count]}). Taxa are stored
+    by name through taxa ({name: integer code}), and topologies as Newick
+    strings without branch lengths, children ordered by their smallest leaf.
+    """
+    from heist import database
+    from heist import seqtools
+    names = {str(val): key for key, val in taxa.items()}
+    derived = [str(key) for key, val in traits.items() if val == 1]
+    run = dict(run, derived=",".join(sorted([names.get(x, x) for x in derived])))
+
+    histogram = OrderedDict()
+    for i, counts in enumerate([mutation_counts_c, mutation_counts_d]):
+        for item in counts:
+            histogram.setdefault(item[0], [0, 0])[i] += item[1]
+    origins = [[names.get(row[0], row[0])] + row[1:] for row in origin_rows(reduced or {}, derived)]
+    canonical = OrderedDict()
+    for tree, count in (topologies or {}).values():
+        key = seqtools.canonical(ints2names(tree, taxa))[0]
+        canonical[key] = canonical.get(key, 0) + count
+    database.record_run(db, run, stats, histogram, origins, canonical)
+
+
+def summary_stats(summary, mutation_counts_c, mutation_counts_d, counts, min_mutations_required):
+    """
+    Returns the summary counts reported for a run, in the order of the raw
+    output file: matched loci, "true" hemiplasy, combinations of hemiplasy
+    and homoplasy, "true" homoplasy, discordant, concordant, introgressed
+    and species history.
+    """
+    if min_mutations_required != 2:
+        mix_range = list(range(2, min_mutations_required))
+    else:
+        mix_range = [0]
+    true_hemi = 0
+    mix = 0
+    true_homo = 0
+    for item in mutation_counts_d:
+        if item[0] == 1:
+            true_hemi = item[1]
+        elif item[0] in mix_range:
+            mix += item[1]
+        elif item[0] >= min_mutations_required:
+            true_homo += item[1]
+    for item in mutation_counts_c:
+        if item[0] >= min_mutations_required:
+            true_homo += item[1]
+
+    return [sum([true_hemi, mix, true_homo]), true_hemi, mix, true_homo,
+            summary[0], summary[1] - summary[0], counts[1], counts[0]]
+
+
+def write_variant_summary(filename, labels, trees, stats, reps, mutationrate, seed, pooled=False):
+    """
+    Writes a summary table of runs on several species trees: the regression
+    point estimate and its CI bounds, or a set of bootstrap/posterior trees.
+    stats holds the counts returned by summary_stats for each tree. If pooled
+    is set, a row summing all trees is added.
+    """
+    columns = ["Matched", "Hemi", "Mixed", "Homo", "Disc", "Conc", "Intro", "Species"]
+
+    out1 = open(filename + '.txt', "w")
+    out1.write("### SPECIES TREES ###\n\n")
+    for label, tree in zip(labels, trees):
+        out1.write(label + ":\n " + tree + "\n\n")
+    if pooled:
+        out1.write(str("{:.2e}".format(reps)) + " simulations performed across " + str(len(labels))
+                   + " trees, using a mutation rate of " + str(mutationrate) + " and seed " + str(seed) + "\n")
+    else:
+        out1.write(str("{:.2e}".format(reps)) + " simulations performed per tree, using a mutation rate of "
+                   + str(mutationrate) + " and seed " + str(seed) + "\n")
+        out1.write("Trees share random number streams, so differences between them reflect the tree\n")
+
+    out1.write("\n### RESULTS ###\n\n")
+    out1.write("Matched: loci matching the species character states\n")
+    out1.write("Hemi: \"true\" hemiplasy (1 mutation)\n")
+    out1.write("Mixed: combinations of hemiplasy and homoplasy\n")
+    out1.write("Homo: \"true\" homoplasy (>= Fitch parsimony score)\n")
+    out1.write("Disc/Conc: loci with a discordant/concordant gene tree\n")
+    out1.write("Intro/Species: loci originating from an introgressed/the species history\n\n")
+    out1.write("Tree\t" + "\t".join(columns) + "\n")
+    for label, s in zip(labels, stats):
+        out1.write(label + "\t" + "\t".join([str(x) for x in s]) + "\n")
+    if pooled:
+        totals = [sum([s[i] for s in stats]) for i in range(len(columns))]
+        out1.write("Pooled\t" + "\t".join([str(x) for x in totals]) + "\n")
+    out1.close()
+
+
+def read_shard(prefix):
+    """
+    Reads the output of one HeiST run (a shard) for heistMerge: the summary
+    counts, mutation rate, mutation count distributions and mutation origins
+    and number of simulations of prefix_raw.txt, and the input summary of
+    prefix.txt with its Fitch parsimony threshold (and number of
+    simulations, rounded, for raw files without it). Returns a dictionary.
+    """
+    head = ""
+    with open(prefix + ".txt") as f:
+        for line in f:
+            if line.startswith("### RESULTS ###"):
+                break
+            head += line
+    reps = re.search(r"^(\S+) simulations performed", head, re.M)
+    threshold = re.search(r"With homoplasy only, (\d+) mutations are required", head)
+
+    shard = {"head": head.rstrip("\n") + "\n", "reps": int(float(reps.group(1))) if reps else None,
+             "threshold": int(threshold.group(1)) if threshold else None,
+             "counts": [], "mutationrate": None,
+             "All": OrderedDict(), "Conc": OrderedDict(), "Disc": OrderedDict(), "Taxa": OrderedDict()}
+    with open(prefix + "_raw.txt") as f:
+        for line in f:
+            l = line.strip().split(",")
+            if l[0] == "":
+                continue
+            if len(l) == 1:
+                # Eight summary counts, then the mutation rate
+                if len(shard["counts"]) < 8:
+                    shard["counts"].append(int(l[0]))
+                else:
+                    shard["mutationrate"] = l[0]
+            elif l[0] == "Replicates":
+                # Exact count; the report only has it rounded
+                shard["reps"] = int(l[1])
+            elif l[0] in ("All", "Conc", "Disc"):
+                shard[l[0]][l[1]] = shard[l[0]].get(l[1], 0) + int(l[2])
+            elif l[0].startswith("Taxa"):
+                shard["Taxa"][l[0]] = [int(x) for x in l[1:4]]
+    if len(shard["counts"]) != 8:
+        sys.exit("Error: " + prefix + "_raw.txt is not a HeiST raw output file")
+    return shard
+
+
+def merge_shards(a, b):
+    """
+    Sums two shards from read_shard. They must share the mutation rate and
+    Fitch parsimony threshold; the input summary of a is kept.
+    """
+    for key in ["mutationrate", "threshold"]:
+        if a[key] != None and b[key] != None and a[key] != b[key]:
+            sys.exit("Error: cannot merge runs with different " + {"mutationrate": "mutation rates",
+                     "threshold": "Fitch parsimony thresholds"}[key])
+    merged = {"head": a["head"],
+              "reps": a["reps"] + b["reps"] if a["reps"] != None and b["reps"] != None else None,
+              "threshold": a["threshold"] if a["threshold"] != None else b["threshold"],
+              "counts": [x + y for x, y in zip(a["counts"], b["counts"])],
+              "mutationrate": a["mutationrate"] if a["mutationrate"] != None else b["mutationrate"]}
+    for key in ["All", "Conc", "Disc"]:
+        merged[key] = OrderedDict(a[key])
+        for k, v in b[key].items():
+            merged[key][k] = merged[key].get(k, 0) + v
+    merged["Taxa"] = OrderedDict([(k, list(v)) for k, v in a["Taxa"].items()])
+    for k, v in b["Taxa"].items():
+        merged["Taxa"][k] = [x + y for x, y in zip(merged["Taxa"].get(k, [0, 0, 0]), v)]
+    return merged
+
+
+def reduce_shards(prefixes, threads=1):
+    """
+    Reads the shards at prefixes concurrently and merges them pairwise, in
+    a tree, on threads workers. Categories keep their order of first
+    appearance in prefixes.
+    """
+    with ThreadPoolExecutor(max_workers = threads) as pool:
+        shards = list(pool.map(read_shard, prefixes))
+        while len(shards) > 1:
+            pairs = [shards[i:i + 2] for i in range(0, len(shards), 2)]
+            shards = list(pool.map(lambda pair: merge_shards(*pair) if len(pair) == 2 else pair[0], pairs))
+    return shards[0]
+
+
+def format_merged(shard):
+    """Text of the merged summary of heistMerge: the input summary, then the results."""
+    threshold = str(shard["threshold"]) if shard["threshold"] != None else "____"
+    head = shard["head"]
+    if shard["reps"] != None:
+        # Exact when the short form would round the total
+        reps = "{:.2e}".format(shard["reps"])
+        if float(reps) != shard["reps"]:
+            reps = str(shard["reps"])
+        head = re.sub(r"^\S+ simulations performed", reps + " simulations performed", head, count=1, flags=re.M)
+    c = shard["counts"]
+    out = head + "\n\n### RESULTS ###\n"
+    out += str(c[0]) + " loci matched the species character states\n\n"
+    out += '"True" hemiplasy (1 mutation) occurs ' + str(c[1]) + " time(s)\n\n"
+    out += "Combinations of hemiplasy and homoplasy (1 < # mutations < " + threshold + ") occur " + str(c[2]) + " time(s)\n\n"
+    out += '"True" homoplasy (>= ' + threshold + ' mutations) occurs ' + str(c[3]) + " time(s)\n\n"
+    out += str(c[4]) + " loci have a discordant gene tree\n\n"
+    out += str(c[5]) + " loci are concordant with the species tree\n\n"
+    out += str(c[6]) + " loci originate from an introgressed history\n\n"
+    out += str(c[7]) + " loci originate from the species history\n\n"
+    out += "Distribution of mutation counts:\n\n# Mutations\t# Trees\n"
+    for key, title in [("All", "On all trees:\n"), ("Conc", "\nOn concordant trees:\n"), ("Disc", "\nOn discordant trees:\n")]:
+        out += title + "".join([str(k) + "\t\t" + str(v) + "\n" for k, v in shard[key].items()])
+    out += "\n\nOrigins of mutations leading to observed character states for hemiplasy + homoplasy cases:\n\n"
+    out += "\tTip mutation\tInternal branch mutation\tTip reversal\n"
+    for key, val in shard["Taxa"].items():
+        out += key + "\t" + "\t".join([str(v) for v in val]) + "\n"
+    return out
+
+
+def write_merged(shard, prefix):
+    """
+    Writes a merged shard as prefix.txt and prefix_raw.txt, which heistMerge
+    can read back to merge more runs into it.
+    """
+    with open(prefix + ".txt", "w") as out1:
+        out1.write(format_merged(shard))
+    with open(prefix + "_raw.txt", "w") as out2:
+        out2.write("".join([str(x) + "\n" for x in shard["counts"]]))
+        if shard["mutationrate"] != None:
+            out2.write(shard["mutationrate"] + "\n")
+        if shard["reps"] != None:
+            out2.write("Replicates," + str(shard["reps"]) + "\n")
+        for key in ["All", "Conc", "Disc"]:
+            out2.write("".join([key + "," + str(k) + "," + str(v) + "\n" for k, v in shard[key].items()]))
+        out2.write("".join([k + "," + ",".join([str(x) for x in v]) + "\n" for k, v in shard["Taxa"].items()]))
+
 
 def plot_mutations(mutation_counts_c, mutation_counts_d, filename):
     """
     Plot mutation distribution with matplotlib
     """
+    import matplotlib.pyplot as plt
+    import numpy as np
 
     mutation_counts_comb = {}
     mutation_counts_keys = set()
@@ -553,157 +1098,57 @@ def plot_mutations(mutation_counts_c, mutation_counts_d, filename):
 
 
 def subs2coal(newick_string):
-        
-        '''
-        Takes a newick string with the nodes labelled with concordance factors,
-        and returns the same string with branch lengths converted to coalescent
-        units.
-        '''
-
-        scfs = re.findall("\)(.*?)\:", newick_string) #regex to get concordance factors
-        scfs = list(filter(None, scfs)) #removes empty values (root has no scf)
-        coal_internals = []
-
-        for i in range(len(scfs)):
-
-                if (float(scfs[i])/100) < 1 and float(scfs[i]) != 1: #catch for missing data / values of 1
-                        coal_estimate = -1*(math.log(3/2) + math.log(1 - float(scfs[i])/100))
-                        if coal_estimate > 0:
-                                coal_internals.append(coal_estimate)
-                        else:
-                                coal_internals.append(0.01)
-                else:
-                        coal_internals.append(np.NaN)
-
-        coal_internals = [float(i) for i in coal_internals]
-        newick_internals = []
-        internal_sections = []
-        sections = newick_string.split(':')
-
-        for i in range(len(sections)):
-                if len(sections[i].split(")")) > 1 and sections[i].split(")")[1] in scfs:
-                                newick_internals.append(newick_string.split(':')[i+1].split(',')[0].split(")")[0])
-                                internal_sections.append(sections[i+1])
-
-        
-        newick_internals = [float(i) for i in newick_internals]
-         
-        def branch_regression(newick_branches, coal_internals):
-
-                '''
-                Returns the regression coefficient of the coalescent branch lengths
-                on the branch lengths in the newick string
-                '''
-
-                newick_reg_branches = copy.deepcopy(newick_branches)
-                coal_reg_internals = copy.deepcopy(coal_internals)
-
-                for i in range(len(newick_branches)): #drops missing data
-                        if np.isnan(newick_branches[i]) or np.isnan(coal_internals[i]):
-                                newick_reg_branches[i] = "N/A"
-                                coal_reg_internals[i] = "N/A"
-                                #del newick_branches[i]
-                                #del coal_internals[i]
-
-                while "N/A" in newick_reg_branches:
-                    newick_reg_branches.remove("N/A")
-
-                while "N/A" in coal_reg_internals:
-                    coal_reg_internals.remove("N/A")
-
-                #print(newick_reg_branches)
-                #print(coal_reg_internals)
-
-                intercept, slope = poly.polyfit(newick_reg_branches, coal_reg_internals, 1)
-
-                return intercept, slope
-
-        intercept, coef = branch_regression(newick_internals, coal_internals)
-        n = newick_internals
-        c = coal_internals
-        tip_sections = []
-
-        for i in range(len(sections)): #gets the sections with tip lengths
-                if sections[i] not in internal_sections:
-                        tip_sections.append(sections[i])
-
-        newick_tips = []
-
-        for i in range(len(tip_sections)): #gets the tip lengths
-                if len(tip_sections[i].split(',')) > 1:
-                        newick_tips.append(tip_sections[i].split(',')[0])
-                elif len(tip_sections[i].split(')')) > 1:
-                        newick_tips.append(tip_sections[i].split(')')[0])
-        
-        newick_tips = [float(i) for i in newick_tips]
-
-        coal_tips = [(newick_tips[i]*coef + intercept) for i in range(len(newick_tips))]
-
-        for i in range(len(coal_tips)):
-                if coal_tips[i] <= 0:
-                        coal_tips[i] = 0.01
-                else:
-                        coal_tips[i] = coal_tips[i]
-
-        prediction_stdev = np.std(coal_tips) #standard deviation of tip predictions
-        coal_tips_lower_CI = [(tip - 1.96*prediction_stdev) for tip in coal_tips]
-        coal_tips_upper_CI = [(tip + 1.96*prediction_stdev) for tip in coal_tips]
-
-        coal_internals = [(newick_internals[i]*coef + intercept) if np.isnan(coal_internals[i]) else coal_internals[i] for i in range(len(newick_internals))]
-        coal_internals_lower_CI = [((newick_internals[i]*coef + intercept) - 1.96*prediction_stdev) if np.isnan(coal_internals[i]) else coal_internals[i] for i in range(len(newick_internals))]
-        coal_internals_upper_CI = [((newick_internals[i]*coef + intercept) + 1.96*prediction_stdev) if np.isnan(coal_internals[i]) else coal_internals[i] for i in range(len(newick_internals))]
-
-        lengths = re.findall("\d+\.\d+", newick_string)
-
-        lengths = [lengths[i] for i in range(len(lengths)) if float(lengths[i]) < 1]
-
-        coal_lengths = []
-        coal_lengths_lower_CI = []
-        coal_lengths_upper_CI = []
-
-        for i in range(len(lengths)):
-                if newick_internals.count(lengths[i]) > 1 or newick_tips.count(lengths[i]) > 1:
-                        sys.exit('Error: Duplicate branch lengths')
-                elif float(lengths[i]) in newick_internals:
-                        coal_lengths.append(coal_internals[newick_internals.index(float(lengths[i]))])
-                        coal_lengths_lower_CI.append(coal_internals_lower_CI[newick_internals.index(float(lengths[i]))])
-                        coal_lengths_upper_CI.append(coal_internals_upper_CI[newick_internals.index(float(lengths[i]))])
-                elif float(lengths[i]) in newick_tips:
-                        coal_lengths.append(coal_tips[newick_tips.index(float(lengths[i]))])
-                        coal_lengths_lower_CI.append(coal_tips_lower_CI[newick_tips.index(float(lengths[i]))])
-                        coal_lengths_upper_CI.append(coal_tips_upper_CI[newick_tips.index(float(lengths[i]))])
-                elif float(lengths[i]) == 0: #deals with roots of length 0 in smoothed trees
-                        coal_lengths.append(float(0))
-        
-        coal_lengths = [str(coal_lengths[i]) for i in range(len(coal_lengths))]
-        coal_lengths_lower_CI = [str(coal_lengths_lower_CI[i]) for i in range(len(coal_lengths_lower_CI))]
-        coal_lengths_upper_CI = [str(coal_lengths_upper_CI[i]) for i in range(len(coal_lengths_upper_CI))]
-       
-        coal_newick_string = copy.deepcopy(newick_string)
-        coal_newick_string_lower_CI = copy.deepcopy(newick_string)
-        coal_newick_string_upper_CI = copy.deepcopy(newick_string)
-
-        for i in range(len(lengths)):
-             coal_newick_string = coal_newick_string.replace(str(lengths[i]), str(coal_lengths[i]))
-             coal_newick_string_lower_CI = coal_newick_string_lower_CI.replace(str(lengths[i]), str(coal_lengths_lower_CI[i]))
-             coal_newick_string_upper_CI = coal_newick_string_upper_CI.replace(str(lengths[i]), str(coal_lengths_upper_CI[i]))
-    
-        scfs = [float(x) for x in scfs]
-        scfs2 = []
-        for val in scfs:
-            if val.is_integer():
-                scfs2.append(str(val) + ".0")
-            else:
-                scfs2.append(str(val))
-
-
-        for i in range(len(scfs)):
-                coal_newick_string = coal_newick_string.replace(str(scfs[i]), '')
-                coal_newick_string_lower_CI = coal_newick_string_lower_CI.replace(str(scfs[i]), '')
-                coal_newick_string_upper_CI = coal_newick_string_upper_CI.replace(str(scfs[i]), '')
-
-        return(coal_newick_string, Tree(coal_newick_string, format=1), coal_newick_string_lower_CI, Tree(coal_newick_string_lower_CI, format=1),
-                coal_newick_string_upper_CI, Tree(coal_newick_string_upper_CI, format=1), intercept, coef, n, c)
+    '''
+    Takes a newick string with the nodes labelled with concordance factors,
+    and returns the same tree with branch lengths converted to coalescent
+    units, together with the trees at the lower and upper bounds of the 95%
+    CI, the regression intercept and slope, and the internal branch lengths
+    in the input (X) and coalescent units (Y, nan where missing).
+
+    Internal branches are converted from their concordance factor (in
+    percent) as -log(3/2 (1 - CF)), at least 0.01; factors of 1 or >= 100
+    are missing. Tips and internal branches with missing factors are
+    predicted from the regression of Y on X; tip predictions are at least
+    0.01 and the CIs span 1.96 standard deviations of the tip predictions.
+    '''
+    import numpy as np
+    import numpy.polynomial.polynomial as poly
+
+    t = Tree(newick_string)
+    tips = np.array(t.leaves(), dtype=np.int64)
+    internals = np.array([n for n in t.postorder() if n != t.root and not t.is_leaf(n)], dtype=np.int64)
+    try:
+        cfs = np.array([float(t.names[n]) if t.names[n] != "" else np.nan for n in internals], dtype=float)
+    except ValueError:
+        sys.exit("Error: internal node labels must be concordance factors: " + newick_string)
+    dists = np.array(t.dists, dtype=float)
+    newick_internals = dists[internals]
+    newick_tips = dists[tips]
+
+    known = (cfs / 100 < 1) & (cfs != 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        estimates = -1 * (np.log(3/2) + np.log(1 - cfs / 100))
+    coal_internals = np.where(known, np.where(estimates > 0, estimates, 0.01), np.nan)
+
+    if not known.any():
+        sys.exit("Error: no internal branch has a concordance factor to convert: " + newick_string)
+    intercept, coef = poly.polyfit(newick_internals[known], coal_internals[known], 1)
+
+    coal_tips = newick_tips * coef + intercept
+    coal_tips[coal_tips <= 0] = 0.01
+    prediction_stdev = np.std(coal_tips) #standard deviation of tip predictions
+    predicted = newick_internals * coef + intercept
+
+    trees = []
+    for shift in [0, -1.96 * prediction_stdev, 1.96 * prediction_stdev]:
+        dists[tips] = coal_tips + shift
+        dists[internals] = np.where(known, coal_internals, predicted + shift)
+        bound = t.copy()
+        bound.dists = dists.tolist()
+        trees.append(bound.write(format=5, dist_formatter="%r"))
+
+    return(trees[0], Tree(trees[0]), trees[1], Tree(trees[1]), trees[2], Tree(trees[2]),
+           intercept, coef, newick_internals.tolist(), coal_internals.tolist())
 
 
 def readInput(file):
@@ -756,6 +1201,54 @@ def readInput(file):
     return(tree, derived, admix, outgroup, treeType, tree2, conversionType)
 
 
+def readTrees(file):
+    """
+    Reads a file of species trees, one Newick string per line. NEXUS tree
+    lines (e.g. "tree rep.1 = (...);") are also accepted.
+    """
+    trees = []
+    for line in open(file, "r"):
+        if "(" not in line:
+            continue
+        trees.append(line[line.index("("):].strip())
+    return trees
+
+
+def prepare_species_tree(newick, derived, outgroup, conversion_type, type):
+    """
+    Prunes a species tree in coalescent units, relabels its taxa as ms
+    integers and derives the ms splits. Returns the relabeled tree, the
+    splits, the taxon conversions and the trait pattern.
+    """
+    t = Tree(newick)
+    if outgroup != None:
+        prune_to_outgroup(t, derived, outgroup)
+    names = t.leaf_names()
+    tree, conversions = names2ints(t, conversion_type, type)
+    splits, taxa = newick2ms(tree)
+
+    traits = {}
+    for name in names:
+        if name in derived:
+            traits[conversions[name]] = 1
+        else:
+            traits[conversions[name]] = 0
+    return (tree, splits, taxa, conversions, traits)
+
+
+def convert_admix(admix, conversions):
+    """
+    Converts introgression events to ms population codes, halves their
+    timing and sorts them from earliest to latest.
+    """
+    events = []
+    for e in admix:
+        events.append([str(float(e[0])/2.0), str(conversions[e[1]]), str(conversions[e[2]]), e[3]])
+    #Sort admix list earliest to latest (not sure if ms requires this or not)
+    events.sort(key = lambda x: float(x[0]), reverse=True)
+    return events
+
+
 def summarize_inherited(inherited):
     reduced = {}
     for event in inherited:
@@ -779,65 +1272,46 @@ def summarize_inherited(inherited):
     return reduced
 
 
-def update_count(tree, dic):
-    for key, val in dic.items():
-        if seqtools.compareToSpecies(key, tree):
-            dic[key] += 1
-    return dic
-
-
-def write_unique_trees(focal_trees, filename, traits):
-    unique = []
-    counts = {}
+def write_unique_trees(topologies, filename, traits, top=None):
+    """
+    Draws each distinct gene tree topology ({topology: [first tree, count]},
+    in order of first appearance) with its count in the report, most
+    frequent first. With top, only the top most frequent topologies are
+    drawn.
+    """
+    ranked = sorted(topologies.values(), key = lambda x: x[1], reverse = True)
     out1 = open(filename+'.txt', "a")
-    outTrees = open(filename+'.trees', 'w')
-    for i, tree in enumerate(focal_trees):
-        outTrees.write(tree + '\n')
-        if i == 0:
-            unique.append(tree)
-            counts[tree] = 1
-        else:
-            uniq = True
-            for tree2 in unique:
-                if seqtools.compareToSpecies(tree, tree2):
-                    uniq = False
-                    counts = update_count(tree, counts)
-            if uniq is True:
-                unique.append(tree)
-                counts[tree] = 1
     out1.write("\n### OBSERVED GENE TREES ###\n\n")
-    for tree in unique:
+    for tree, count in ranked[:top]:
         for key, val in traits.items():
             if val == 1:
                 tree = re.sub(r"\b%s\b" % str(key)+":", str(key) + "*:", tree)
-        t = tree
-        t = t.replace(";", "")
-        t = Phylo.read(io.StringIO(t), "newick")
-        Phylo.draw_ascii(t, out1, column_width=40)
-        for key, val in counts.items():
-
-            if seqtools.compareToSpecies(key, tree):
-                out1.write("This topology occured " + str(val) + " time(s)\n")
-
+        Tree(tree).draw_ascii(out1, column_width=40)
+        out1.write("This topology occured " + str(count) + " time(s)\n")
+    if top != None and len(ranked) > top:
+        out1.write("\n" + str(len(ranked) - top) + " less frequent topologies (" +
+                   str(sum([x[1] for x in ranked[top:]])) + " trees) not shown\n")
     out1.close()
-    outTrees.close()
 
 
-def prune_tree(tree, derived, outgroup):
-    t = Tree(tree, format=1)
-    for leaf in t:
-        if leaf.name in derived:
-            leaf.add_features(derived='1')
-        else:
-            leaf.add_features(derived='0')
-    ns = []
-    for node in t.get_monophyletic(values=["1"], target_attr="derived"):
-       ns.append(node)
-    sub = t.get_common_ancestor(ns)
-    tokeep = list(sub.get_leaf_names())
+def prune_to_outgroup(t, derived, outgroup):
+    """
+    Prunes a Tree to the smallest clade containing all derived taxa, plus
+    the outgroup. Trees where the derived taxa form one clade are kept whole.
+    """
+    clades = t.monophyletic(derived)
+    if len(clades) == 1:
+        sub = t.root
+    else:
+        sub = t.common_ancestor(clades)
+    tokeep = t.leaf_names(sub)
     tokeep.append(outgroup)
     t.prune(tokeep)
 
+
+def prune_tree(tree, derived, outgroup):
+    t = Tree(tree)
+    prune_to_outgroup(t, derived, outgroup)
     return(t.write(format = 1), t)
     
 def make_introgression_tree(tree2, conversions):
@@ -845,20 +1319,17 @@ def make_introgression_tree(tree2, conversions):
     #Will allow us to easily specify introgression on internal nodes.
     node_conversions = {}
     #Change taxa names to ms ints
-    for key, val in conversions.items():
-        tree2 = re.sub(key, str(val), tree2)
-
-    #Convert to ete3 tree
-    tree2 = Tree(tree2, format = 1)
+    tree2 = Tree(tree2)
+    tree2.relabel(conversions)
 
     #Traverse tree
-    for node in tree2.traverse():
-        descendants = node.get_leaf_names()
+    for node in tree2.levelorder():
+        descendants = tree2.leaf_names(node)
         #if not a leaf
         if len(descendants) != 1:
             ds = [int(x) for x in descendants]
-            node_conversions[node.name] = str(min(ds))
-            node.name = node.name + '/' + str(min(ds))
+            node_conversions[tree2.names[node]] = str(min(ds))
+            tree2.names[node] = tree2.names[node] + '/' + str(min(ds))
 
     return(tree2, tree2.write(format = 1), node_conversions)
 
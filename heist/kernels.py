@@ -0,0 +1,154 @@
+# /usr/bin/python3
+import os
+import numpy as np
+
+"""
+Hemiplasy Tool
+Authors: Matt Gibson, Mark Hibbins
+Indiana University
+
+Compiled versions of the per-locus loops in seqtools, over integer-encoded
+arrays. They are used when Numba is installed (set HEIST_NOJIT to disable
+them); otherwise seqtools falls back to its Python implementations. Both
+give identical results.
+"""
+
+try:
+    from numba import njit
+    ENABLED = not os.environ.get("HEIST_NOJIT")
+except ImportError:
+    ENABLED = False
+
+    def njit(*args, **kwargs):
+        def wrap(f):
+            return f
+        return wrap
+
+
+# Bits of the nucleotides in seq-gen output, indexed by character code,
+# and the nucleotide of each bit
+NUCLEOTIDES = np.zeros(256, dtype=np.uint8)
+BASES = np.full(16, "N")
+for _bit, _base in enumerate("ACGT"):
+    NUCLEOTIDES[ord(_base)] = 1 << _bit
+    BASES[1 << _bit] = _base
+
+
+@njit(cache=True)
+def _is_space(c):
+    return c == 32 or c == 9 or c == 13
+
+
+@njit(cache=True)
+def _check_block(labels, states, ntaxa, trait):
+    """Trait pattern check of readSeqs for one locus of nucleotide bits."""
+    root = ntaxa + 1
+    root_state = -1
+    levels = 0
+    a_first = -1
+    a_equal = True
+    b_first = -1
+    b_equal = True
+    for q in range(labels.shape[0]):
+        label = labels[q]
+        state = states[q]
+        if label >= 1 and label <= ntaxa:
+            levels |= state
+        if label == root:
+            root_state = state
+        if label < trait.shape[0]:
+            if trait[label] == 0:
+                if a_first == -1:
+                    a_first = state
+                elif state != a_first:
+                    a_equal = False
+            elif trait[label] == 1:
+                if b_first == -1:
+                    b_first = state
+                elif state != b_first:
+                    b_equal = False
+    nlevels = 0
+    while levels:
+        nlevels += levels & 1
+        levels >>= 1
+    return nlevels == 2 and a_equal and b_equal and b_first != root_state
+
+
+@njit(cache=True)
+def _scan_seqs(buf, p, ntaxa, trait, nucleotides, out_index, out_labels, out_states, fill):
+    """
+    Walks the bytes of a seq-gen file, assembling a block from every p
+    "label allele" lines. Returns the number of loci matching the trait
+    pattern and the number of loci; with fill set, also records the
+    matching loci's indices and blocks.
+    """
+    n = buf.shape[0]
+    labels = np.zeros(p, dtype=np.int64)
+    states = np.zeros(p, dtype=np.uint8)
+    iii = 0
+    index = 0
+    nmatch = 0
+    i = 0
+    while i < n:
+        j = i
+        while j < n and buf[j] != 10:
+            j += 1
+        k = i
+        while k < j and _is_space(buf[k]):
+            k += 1
+        t1s = k
+        while k < j and not _is_space(buf[k]):
+            k += 1
+        t1e = k
+        while k < j and _is_space(buf[k]):
+            k += 1
+        t2s = k
+        while k < j and not _is_space(buf[k]):
+            k += 1
+        t2e = k
+        i = j + 1
+
+        if t2e - t2s != 1 or nucleotides[buf[t2s]] == 0:
+            continue
+        label = 0
+        for c in range(t1s, t1e):
+            label = label * 10 + (buf[c] - 48)
+        labels[iii] = label
+        states[iii] = nucleotides[buf[t2s]]
+        iii += 1
+        if iii == p:
+            iii = 0
+            if _check_block(labels, states, ntaxa, trait):
+                if fill:
+                    out_index[nmatch] = index
+                    out_labels[nmatch, :] = labels
+                    out_states[nmatch, :] = states
+                nmatch += 1
+            index += 1
+    return (nmatch, index)
+
+
+def scan_range(seqs, start, end, ntaxa, speciesPattern, p):
+    """Compiled seqtools.scan_range, over a memory map of the byte range."""
+    # Read-only in both cases, so the kernel is compiled once
+    if end > start:
+        buf = np.asarray(np.memmap(seqs, dtype=np.uint8, mode="r", offset=start, shape=(end - start,)))
+    else:
+        buf = np.frombuffer(b"", dtype=np.uint8)
+    return scan_buffer(buf, ntaxa, speciesPattern, p)
+
+
+def scan_buffer(buf, ntaxa, speciesPattern, p):
+    """Compiled seqtools.scan_buffer, over a read-only uint8 array of the loci."""
+    trait = np.full(max(list(speciesPattern.keys()) + [ntaxa + 1]) + 1, -1, dtype=np.int64)
+    for key, val in speciesPattern.items():
+        trait[int(key)] = val
+
+    empty = np.zeros((0, p), dtype=np.int64)
+    nmatch, nloci = _scan_seqs(buf, p, ntaxa, trait, NUCLEOTIDES, np.zeros(0, dtype=np.int64),
+                               empty, empty.astype(np.uint8), False)
+    out_index = np.zeros(nmatch, dtype=np.int64)
+    out_labels = np.zeros((nmatch, p), dtype=np.int64)
+    out_states = np.zeros((nmatch, p), dtype=np.uint8)
+    _scan_seqs(buf, p, ntaxa, trait, NUCLEOTIDES, out_index, out_labels, out_states, True)
+    return (out_index, out_labels, out_states, nloci)
@@ -1,8 +1,18 @@
 # /usr/bin/python3
-from itertools import zip_longest
-from Bio.Phylo.Consensus import _BitString
-from Bio import Phylo
+from itertools import zip_longest, chain
+from heist import kernels
+from heist import transport
+from heist.tree import Tree
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker
+from collections import OrderedDict, deque
+import numpy as np
+import gzip
+import mmap
+import os
+import sys
 import io
+import contextlib
 import re
 
 """
@@ -15,6 +25,23 @@ Scripts that do the parsing of gene trees and sequences.
 
 resultss = 0
 
+# Locus header line written by seq-gen before each block
+HEADER = re.compile(rb"\n *\d+ +\d+ *\r?\n")
+
+# Magic numbers of compressed intermediate files
+MAGIC = {b"\x1f\x8b": "gzip", b"\x28\xb5\x2f\xfd": "zstd"}
+
+# Newick leaf names, and tokens (brackets, commas, branch lengths, names)
+LEAF = re.compile(r"[(,]\s*([^(),:;\s]+)")
+TOKEN = re.compile(r"[(),]|:[^(),;]*|[^(),:;\s]+")
+BRANCH = re.compile(r":[^(),;]*")
+
+# Least recently used caches of topologies and of canonical topologies (both
+# keyed by the tree without branch lengths), with [hits, misses] per cache
+TOPOLOGY_CACHE_SIZE = 10000
+caches = {"topology": OrderedDict(), "canonical": OrderedDict()}
+cache_counts = {"topology": [0, 0], "canonical": [0, 0]}
+
 
 def grouper(iterable, n, fillvalue=None):
     """
@@ -34,16 +61,139 @@ def cluster(d):
     return clusters
 
 
-def getSisters(tree, t="g"):
-    """Some nasty regex to get pairs of sister taxa
-    (only at terminal branches)"""
-    if t == "s":
-        l = re.findall("\(([1-9][0-9]|\d),([1-9][0-9]|\d)\)", tree)
-    else:
-        l = re.findall(
-            "\(([1-9][0-9]|\d):\d\.\d\d\d,([1-9][0-9]|\d):\d\.\d\d\d\)", tree
-        )
-    return l
+def topology(newick):
+    """
+    Parses a Newick tree once into a canonical, hashable topology: the
+    sorted leaf names and the frozenset of the leaf sets of its internal
+    nodes (root included), each an integer bitmask over the sorted leaves.
+    Branch lengths and internal node labels are ignored, and there is no
+    limit on the number of taxa.
+    """
+    leaves = tuple(sorted(LEAF.findall(newick)))
+    bit = {name: 1 << i for i, name in enumerate(leaves)}
+    clades = set()
+    stack = [0]
+    leaf = True
+    for token in TOKEN.findall(newick):
+        if token == "(":
+            stack.append(0)
+            leaf = True
+        elif token == ",":
+            leaf = True
+        elif token == ")":
+            mask = stack.pop()
+            clades.add(mask)
+            stack[-1] |= mask
+            leaf = False
+        elif token[0] != ":" and leaf:
+            stack[-1] |= bit[token]
+    return (leaves, frozenset(clades))
+
+
+def lru(name, key, func, *args):
+    """Returns caches[name][key], computing it as func(*args) on a miss."""
+    cache = caches[name]
+    if key in cache:
+        cache.move_to_end(key)
+        cache_counts[name][0] += 1
+        return cache[key]
+    cache_counts[name][1] += 1
+    value = func(*args)
+    cache[key] = value
+    if len(cache) > TOPOLOGY_CACHE_SIZE:
+        cache.popitem(last = False)
+    return value
+
+
+def set_cache_size(size):
+    """Sets TOPOLOGY_CACHE_SIZE, evicting the least recently used entries over it."""
+    global TOPOLOGY_CACHE_SIZE
+    TOPOLOGY_CACHE_SIZE = size
+    for cache in caches.values():
+        while len(cache) > size:
+            cache.popitem(last = False)
+
+
+def cached_topology(newick):
+    """topology(newick), served from the cache for repeated topologies."""
+    return lru("topology", BRANCH.sub("", newick), topology, newick)
+
+
+def snapshot_counts():
+    """Copy of the cache counters, for take_counts."""
+    return {name: list(counts) for name, counts in cache_counts.items()}
+
+
+def take_counts(before):
+    """
+    Cache lookups ([hits, misses] per cache) since the snapshot before,
+    taken off this process's counters so that they are counted once, where
+    they are added back with add_counts (e.g. in the parent of a worker).
+    """
+    taken = {}
+    for name, counts in cache_counts.items():
+        taken[name] = [counts[0] - before[name][0], counts[1] - before[name][1]]
+        counts[:] = before[name]
+    return taken
+
+
+def add_counts(taken):
+    """Adds cache lookups from take_counts to this process's counters."""
+    for name, counts in taken.items():
+        cache_counts[name][0] += counts[0]
+        cache_counts[name][1] += counts[1]
+
+
+def cache_summary():
+    """Hit rates of the topology caches, for the verbose output."""
+    lines = []
+    for name, label in [["topology", "Topology cache"], ["canonical", "Canonical topology cache"]]:
+        hits, misses = cache_counts[name]
+        rate = 100.0 * hits / (hits + misses) if hits + misses > 0 else 0.0
+        lines.append(label + ": " + str(hits) + " hits, " + str(misses) + " misses (" +
+                     str(round(rate, 1)) + "% hit rate)")
+    return "\n".join(lines)
+
+
+def canonical(newick):
+    """
+    Canonical form of a gene tree topology, with the children of every node
+    ordered by their smallest leaf: the Newick string without branch
+    lengths, and for each of its branches (in postorder, root excluded) the
+    position of that branch's length in the input string.
+    """
+    t = Tree(newick)
+    written = {n: i for i, n in enumerate([n for n in t.postorder() if n != t.root])}
+    smallest = {}
+    for n in t.postorder():
+        if t.is_leaf(n):
+            name = t.names[n]
+            smallest[n] = (0, int(name), "") if name.isdigit() else (1, 0, name)
+        else:
+            t.children[n].sort(key = lambda c: smallest[c])
+            smallest[n] = smallest[t.children[n][0]]
+    order = [written[n] for n in t.postorder() if n != t.root]
+    return (t.write(format=9), np.array(order, dtype=np.int64))
+
+
+def canonical_lengths(trees, nbranches):
+    """
+    Canonical topologies (see canonical) and branch lengths of a batch of
+    gene trees: the distinct topologies in order of first appearance, each
+    tree's index into them, and a (trees, nbranches) array of branch
+    lengths in canonical order.
+    """
+    topologies = OrderedDict()
+    ids = np.zeros(len(trees), dtype=np.int64)
+    lengths = np.zeros((len(trees), nbranches), dtype=np.float64)
+    for i, tree in enumerate(trees):
+        string, order = lru("canonical", BRANCH.sub("", tree), canonical, tree)
+        if len(order) != nbranches:
+            sys.exit("Error: gene tree does not have " + str(nbranches) + " branches: " + tree)
+        ids[i] = topologies.setdefault(string, len(topologies))
+        written = np.array([float(b[1:]) for b in BRANCH.findall(tree)[:nbranches]])
+        lengths[i] = written[order]
+    return (list(topologies), ids, lengths)
 
 
 def checkEqual(lst):
@@ -53,67 +203,379 @@ def checkEqual(lst):
     return lst[1:] == lst[:-1]
 
 
-def readSeqs(seqs, ntaxa, speciesPattern, nodes, batch, prefix, breaks=0):
+def compression(filename):
+    """Compression of a file from its magic number: "gzip", "zstd" or None."""
+    with open(filename, "rb") as f:
+        head = f.read(4)
+    for magic, kind in MAGIC.items():
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+def open_intermediate(filename, mode="rb", kind=None):
+    """
+    Opens an intermediate file as a stream. Files read are decompressed as
+    they are read if they are gzip or zstd files (concatenated members or
+    frames are read as one stream); files written are compressed with kind
+    ("gzip", "zstd" or None), at the fastest level.
+    """
+    if "r" in mode:
+        kind = compression(filename)
+    if kind == "gzip":
+        return gzip.open(filename, mode, compresslevel=1)
+    if kind == "zstd":
+        if "r" in mode:
+            stream = io.BufferedReader(ZstdReader(filename))
+        else:
+            stream = zstandard_module().ZstdCompressor(level=1).stream_writer(open(filename, "wb"), closefd=True)
+        return io.TextIOWrapper(stream) if "t" in mode else stream
+    return open(filename, mode)
+
+
+def zstandard_module():
+    """The zstandard package, imported on first use of a zstd file."""
+    try:
+        import zstandard
+    except ImportError:
+        sys.exit("Error: zstd-compressed files need the zstandard Python package "
+                 "(pip install heist-hemiplasy[zstd])")
+    return zstandard
+
+
+class ZstdReader(io.RawIOBase):
+    """
+    Decompressed bytes of a zstd file (all frames), for open_intermediate.
+    Seeks forward by decompressing up to the offset and back by starting
+    over, as gzip files do.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stream = None
+        self.rewind()
+
+    def rewind(self):
+        zstandard = zstandard_module()
+        if self.stream != None:
+            self.stream.close()
+        self.stream = zstandard.ZstdDecompressor().stream_reader(open(self.filename, "rb"),
+                                                                 read_across_frames=True, closefd=True)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.stream.readinto(b)
+        self.pos += n
+        return n
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("zstd files can only seek from the start or current position")
+        if offset < self.pos:
+            self.rewind()
+        while self.pos < offset:
+            data = self.stream.read(min(offset - self.pos, 1 << 20))
+            if not data:
+                break
+            self.pos += len(data)
+        return self.pos
+
+    def close(self):
+        if self.stream != None:
+            self.stream.close()
+        super().close()
+
+
+def parse_states(buf):
+    """
+    Parses seq-gen output (bytes) without a Python loop over lines. Returns
+    the node label and nucleotide bit (A=1, C=2, G=4, T=8) of every
+    "label allele" line, in file order, and the byte offset just past each
+    of those lines. Header lines are skipped.
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(data == 10)
+    if len(data) > 0 and data[-1] != 10:
+        ends = np.append(ends, len(data))
+    if len(ends) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8), ends)
+    starts = np.concatenate(([0], ends[:-1] + 1)).astype(np.int64)
+
+    # Last character of each line, ignoring a carriage return
+    last = ends - 1
+    cr = (last >= starts) & (data[np.maximum(last, 0)] == 13)
+    last = last - cr
+    ok = last - 1 >= starts
+    last_c = data[np.maximum(last, 0)]
+    prev_c = data[np.maximum(last - 1, 0)]
+    first_c = data[np.minimum(starts, max(len(data) - 1, 0))]
+    keep = ok & (kernels.NUCLEOTIDES[last_c] != 0) & ((prev_c == 32) | (prev_c == 9)) \
+        & (first_c >= 48) & (first_c <= 57)
+    starts = starts[keep]
+    last = last[keep]
+
+    # Node labels: the digits from the start of the line to the first space
+    space = np.flatnonzero((data == 32) | (data == 9))
+    digits = space[np.searchsorted(space, starts)] - starts
+    labels = np.zeros(len(starts), dtype=np.int64)
+    for k in range(int(digits.max()) if len(digits) else 0):
+        more = k < digits
+        labels[more] = labels[more] * 10 + data[starts[more] + k] - 48
+    return (labels, kernels.NUCLEOTIDES[data[last]], ends[keep] + 1)
+
+
+def parse_chunks(chunks, p):
+    """
+    Parses consecutive chunks of seq-gen output (bytes) into (loci, p)
+    arrays of node labels and nucleotide bits, carrying partial loci over
+    to the next chunk.
+    """
+    carry = b""
+    for data in chain(chunks, [b""]):
+        buf = carry + data
+        if data:
+            buf = buf[:buf.rfind(b"\n") + 1]
+        labels, states, ends = parse_states(buf)
+        nloci = len(labels) // p
+        used = int(ends[nloci * p - 1]) if nloci > 0 else 0
+        carry = (carry + data)[used:]
+        if nloci > 0:
+            yield (labels[:nloci * p].reshape(nloci, p), states[:nloci * p].reshape(nloci, p))
+
+
+def iter_states(seqs, p, chunk_bytes=1 << 26, start=0, end=None):
+    """
+    Streams a seq-gen file, or the byte range [start, end) of it, as
+    (loci, p) arrays of node labels and nucleotide bits in file order. The
+    file is memory-mapped and parsed about chunk_bytes at a time; a
+    compressed file is decompressed as it is read, and always as a whole.
+    """
+    if compression(seqs) != None:
+        with open_intermediate(seqs) as f:
+            yield from parse_chunks(iter(lambda: f.read(chunk_bytes), b""), p)
+        return
+    if end is None:
+        end = os.path.getsize(seqs)
+    if end <= start:
+        return
+    with open(seqs, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        chunks = (mm[pos:min(pos + chunk_bytes, end)] for pos in range(start, end, chunk_bytes))
+        yield from parse_chunks(chunks, p)
+
+
+def locus_ranges(seqs, n, min_bytes=1 << 24):
+    """
+    Splits a seq-gen file into at most n byte ranges of at least about
+    min_bytes, each starting at a locus header line (" ntaxa 1"), so the
+    ranges can be parsed independently.
+    """
+    size = os.path.getsize(seqs)
+    n = max(1, min(n, size // min_bytes))
+    bounds = [0]
+    if n > 1:
+        with open(seqs, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for k in range(1, n):
+                m = HEADER.search(mm, max(size * k // n - 1, bounds[-1]))
+                if m is None:
+                    break
+                if m.start() + 1 > bounds[-1]:
+                    bounds.append(m.start() + 1)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def locus_blocks(seqs, chunk_bytes=1 << 26):
+    """
+    Streams a compressed seq-gen file as decompressed blocks of about
+    chunk_bytes, each ending before a locus header line, so the blocks can
+    be parsed independently.
+    """
+    with open_intermediate(seqs) as f:
+        carry = b""
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+            buf = carry + data
+            m = HEADER.search(buf, len(buf) // 2)
+            if m is None:
+                carry = buf
+                continue
+            carry = buf[m.start() + 1:]
+            yield buf[:m.start() + 1]
+        if carry:
+            yield carry
+
+
+def scan_range(seqs, start, end, ntaxa, speciesPattern, p):
+    """
+    Parses the loci in the byte range [start, end) of a seq-gen file.
+    Returns the indices (within the range) of loci matching the trait
+    pattern, their node labels and nucleotide bits, and the number of loci
+    in the range.
+    """
+    if kernels.ENABLED:
+        return kernels.scan_range(seqs, start, end, ntaxa, speciesPattern, p)
+    return scan_states(iter_states(seqs, p, start=start, end=end), ntaxa, speciesPattern, p)
+
+
+def scan_buffer(buf, ntaxa, speciesPattern, p):
+    """
+    scan_range over a block of whole loci, e.g. from locus_blocks, as bytes
+    or a uint8 array.
+    """
+    buf = np.frombuffer(buf, dtype=np.uint8)
+    if kernels.ENABLED:
+        return kernels.scan_buffer(buf, ntaxa, speciesPattern, p)
+    labels, states = parse_states(buf)[:2]
+    nloci = len(labels) // p
+    block = (labels[:nloci * p].reshape(nloci, p), states[:nloci * p].reshape(nloci, p))
+    return scan_states([block], ntaxa, speciesPattern, p)
+
+
+def scan_states(blocks, ntaxa, speciesPattern, p):
+    """The results of scan_range over consecutive arrays of parse_chunks."""
+    matches = [np.zeros(0, dtype=np.int64)]
+    labs = [np.zeros((0, p), dtype=np.int64)]
+    sts = [np.zeros((0, p), dtype=np.uint8)]
+    nloci = 0
+    for labels, states in blocks:
+        match = np.flatnonzero(match_pattern(labels, states, ntaxa, speciesPattern))
+        matches.append(match + nloci)
+        labs.append(labels[match])
+        sts.append(states[match])
+        nloci += labels.shape[0]
+    return (np.concatenate(matches), np.concatenate(labs), np.concatenate(sts), nloci)
+
+
+def match_pattern(labels, states, ntaxa, speciesPattern):
+    """
+    Vectorized trait pattern check. Returns a boolean array marking the loci
+    in which all derived taxa share one allele, all ancestral taxa share
+    another, and the derived allele differs from the root's.
+    """
+    derived = [int(k) for k, v in speciesPattern.items() if v == 1]
+    ancestral = [int(k) for k, v in speciesPattern.items() if v == 0]
+    by_label = np.zeros((labels.shape[0], labels.shape[1] + 2), dtype=np.uint8)
+    np.put_along_axis(by_label, labels, states, axis=1)
+
+    d = np.bitwise_or.reduce(by_label[:, derived], axis=1)
+    a = np.bitwise_or.reduce(by_label[:, ancestral], axis=1)
+    root = by_label[:, ntaxa + 1]
+    single = lambda x: (x != 0) & ((x & (x - 1)) == 0)
+    return single(d) & single(a) & (d != a) & (d != root)
+
+
+def process_pool(threads):
+    """
+    Process pool of threads workers, all started before it is returned, so
+    that none is forked later from a process with other threads running
+    (e.g. the simulation threads of hemiplasytool.run_pipeline).
+    """
+    # Workers share the parent's resource tracker only if it runs before they
+    # are forked; their own would "clean up" the shared memory they attach
+    resource_tracker.ensure_running()
+    pool = ProcessPoolExecutor(max_workers = threads)
+    wait([pool.submit(os.getpid) for _ in range(threads)])
+    return pool
+
+
+def ordered_map(func, jobs, threads=1, shared=False, pool=None):
+    """
+    Applies func to each argument list of jobs, yielding the results in
+    order. With threads, jobs run on a process pool (pool if given, which
+    is left running, otherwise a new one) with at most twice as many jobs
+    in flight as workers, so finished results do not pile up. With shared,
+    the jobs' NumPy array arguments reach the workers through a ring of
+    shared memory slots (transport.SlotRing) instead of pickles.
+    """
+    if threads <= 1:
+        for args in jobs:
+            yield func(*args)
+        return
+    ring = transport.SlotRing(2 * threads) if shared else None
+    executor = pool if pool != None else ProcessPoolExecutor(max_workers = threads)
+    pending = deque()
+    try:
+        for args in jobs:
+            if ring != None:
+                pending.append(executor.submit(transport.call, func, ring.put(args)))
+            else:
+                pending.append(executor.submit(func, *args))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if pool == None:
+            executor.shutdown()
+        else:
+            wait(pending)
+        if ring != None:
+            ring.close()
+
+
+def write_focal(tmpFocal, ntaxa, labels, states):
+    """Writes locus blocks in seq-gen order to the focal trees file."""
+    for lab, st in zip(labels.tolist(), kernels.BASES[states].tolist()):
+        tmpFocal.write(' ' + str(ntaxa) + ' 1\n')
+        tmpFocal.write("".join([str(l) + "\t" + s + "\n" for l, s in zip(lab, st)]))
+
+
+def readSeqs(seqs, ntaxa, speciesPattern, nodes, batch, prefix, breaks=0, threads=1):
     """
     Reads in sequences, determines if gene tree site pattern matches species tree
-    site pattern. Returns indices of those which do.
+    site pattern. The matching loci are written to prefix.focaltrees.tmp and
+    their 1-based indices (int64) to prefix.trees.match.tmp, as the file is
+    streamed in ranges of about 64 MB parsed by a pool of threads processes.
+    A compressed file is decompressed in one stream and its blocks parsed
+    in parallel (passed to the workers in shared memory), and the focal
+    file is compressed the same way.
+    Returns the number of matches, and the numbers from before and after
+    breaks (the first introgressed locus).
     """
-    indices = []
-    c = cluster(speciesPattern)
-    shouldMatch1 = c[0]
-    shouldMatch2 = c[1]
-    counts = [0,0]
-    tmpFocal = open(prefix + ".focaltrees.tmp", "w")
+    p = ntaxa + nodes
+    kind = compression(seqs)
+    if kind != None:
+        scan = scan_buffer
+        jobs = ([np.frombuffer(block, dtype=np.uint8), ntaxa, speciesPattern, p]
+                for block in locus_blocks(seqs, 1 << 24))
+    else:
+        scan = scan_range
+        ranges = locus_ranges(seqs, max(threads, os.path.getsize(seqs) >> 26))
+        jobs = ([seqs, r[0], r[1], ntaxa, speciesPattern, p] for r in ranges)
 
+    nmatch = 0
+    counts = [0,0]
+    tmpFocal = open_intermediate(prefix + ".focaltrees.tmp", "wt", kind)
+    tmpMatch = open(prefix + ".trees.match.tmp", "wb")
     index = 0
-    iii = 0
-    p = ntaxa + nodes
-    #print(p)
-    with open(seqs, "rU") as f:
-        block = []
-        tax = []
-        for lines in f:
-            #print(block)
-            if iii < p:
-                l = lines.replace("\n", "").split()
-                if l[1] in ['A', 'T', 'C', 'G']:
-                    tax.append(l[0])
-                    block.append(l[1])
-                    iii += 1
-            elif iii == p:
-                iii = 0
-                assert len(block) == ntaxa + nodes
-                pattern = {}
-                for x, line in enumerate(block):
-                    pattern[str(tax[x])] = str(line)
-                block = []
-                tax = []
-                #print(pattern)
-                levels = set()
-                for key, val in pattern.items():
-                    if int(key) in range(1, ntaxa + 1):
-                        levels.add(val)
-                if len(levels) == 2:
-                    a = []
-                    for taxa in shouldMatch1:
-                        a.append(pattern[str(taxa)])
-                    if checkEqual(a):
-                        b = []
-                        for taxa in shouldMatch2:
-                            b.append(pattern[str(taxa)])
-                        if checkEqual(b):
-                            if b[0] != pattern[str(ntaxa + 1)]:
-                                indices.append(index+1)
-                                tmpFocal.write(' ' + str(ntaxa) + ' 1\n')
-                                for k, v in pattern.items():
-                                    tmpFocal.write(k + "\t" + v + "\n")
-                                if index < breaks:
-                                    counts[0] += 1
-                                else:
-                                    counts[1] += 1
-                index += 1
+    for match, labels, states, nloci in ordered_map(scan, jobs, threads, kind != None):
+        match = match + index
+        n_species = int(np.count_nonzero(match < breaks))
+        counts[0] += n_species
+        counts[1] += len(match) - n_species
+        nmatch += len(match)
+        (match + 1).astype(np.int64).tofile(tmpMatch)
+        write_focal(tmpFocal, ntaxa, labels, states)
+        index += nloci
     tmpFocal.close()
-    return (indices, counts)
+    tmpMatch.close()
+    return (nmatch, counts)
+
 
 def readSeqs2(seqs, ntaxa, speciesPattern, nodes, batch, prefix, breaks=[]):
     """
@@ -131,7 +593,7 @@ def readSeqs2(seqs, ntaxa, speciesPattern, nodes, batch, prefix, breaks=[]):
     tmpFocal = open(prefix + ".focaltrees.tmp", "w")
 
     index = 0
-    with open(seqs, "rU") as f:
+    with open(seqs, "r") as f:
         for lines in grouper(f, ntaxa + nodes + 1, ""):
             assert len(lines) == ntaxa + nodes + 1
             pattern = {}
@@ -176,93 +638,98 @@ def readSeqs2(seqs, ntaxa, speciesPattern, nodes, batch, prefix, breaks=[]):
     return (indices, counts)
 
 
-def getTrees(treefile, matchlist):
+def tree_index(treefile):
+    """Path of the byte-offset index of a gene tree file."""
+    if treefile.endswith(".tmp"):
+        return treefile[:-len(".tmp")] + ".idx.tmp"
+    return treefile + ".idx"
+
+
+def index_lines(data, start, linelen, base):
+    """
+    Offsets of the tree lines (longer than 3 characters) that end in a block
+    of a gene tree file. start and linelen describe the line running into
+    the block, base is the block's offset. Returns the offsets and the new
+    start and linelen.
+    """
+    nl = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+    if len(nl) == 0:
+        return (np.zeros(0, dtype=np.int64), start, linelen + len(data))
+    starts = np.concatenate(([start], base + nl[:-1] + 1))
+    lengths = np.concatenate(([linelen + nl[0]], np.diff(nl) - 1))
+    return (starts[lengths > 3], base + int(nl[-1]) + 1, len(data) - int(nl[-1]) - 1)
+
+
+def iter_trees(treefile, matchlist):
     """
-    Returns list of trees at indices obtained from readSeqs
+    Single pass over a gene tree file, yielding (index, tree) for the trees
+    at the 1-based indices in matchlist. Stops after the last match.
     """
-    focal_trees = []
-    trees = open(treefile, "r")
+    wanted = set(matchlist)
+    if not wanted:
+        return
+    last = max(wanted)
     i = 0
-    for line in trees:
-        l = line.replace("\n", "")
-        if len(l) > 3:
-            i += 1
-            if i in matchlist:
-                focal_trees.append(l)
-    trees.close()
-    #for i, tree in enumerate(all_trees):
-    #    if i in matchlist:
-    #        focal_trees.append(tree)
-    #    else:
-    #        trees_dont_follow.append(tree)
+    with open_intermediate(treefile, "rt") as trees:
+        for line in trees:
+            l = line.replace("\n", "")
+            if len(l) > 3:
+                i += 1
+                if i in wanted:
+                    yield (i, l)
+                    if i == last:
+                        break
 
-    return (focal_trees, 0)
 
+def read_array(filename, dtype=np.int64):
+    """Memory-mapped read-only view of an array file (empty if the file is)."""
+    if os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r")
 
-def _bitstrs(tree):
-    bitstrs = set()
-    term_names = [term.name for term in tree.get_terminals()]
-    term_names.sort()
-    for clade in tree.get_nonterminals():
-        clade_term_names = [term.name for term in clade.get_terminals()]
-        boolvals = [name in clade_term_names for name in term_names]
-        bitstr = _BitString("".join(map(str, map(int, boolvals))))
-        bitstrs.add(bitstr)
-    return bitstrs
-
-
-def rev(sis):
-    """Utility function"""
-    return (sis[1], sis[0])
-
-
-def compareToSpecies(tree1, tree2, spp_sisters=None):
-    """Compares tree topologies. Will first check if sister taxa in the species tree are also sister 
-    in the gene tree, returning false at the first non-shared occurence. If all sister taxa are present,
-    it will calculate a bitstring distance with Biopython Phylo."""
-    if spp_sisters == None:
-        spp_sisters = getSisters(tree1)
-    sisters = getSisters(tree2)
-    top = bool
-    for s in sisters:
-        if (s not in spp_sisters) and (rev(s) not in spp_sisters):
-            return False
-
-    tree1 = tree1.replace(";", "")
-    tree2 = tree2.replace(";", "")
-    tree1 = Phylo.read(io.StringIO(tree1), "newick")
-    tree2 = Phylo.read(io.StringIO(tree2), "newick")
-    term_names1 = [term.name for term in tree1.get_terminals()]
-    term_names2 = [term.name for term in tree2.get_terminals()]
-    # false if terminals are not the same
-    if set(term_names1) != set(term_names2):
-        return False
-    # true if _BitStrings are the same
-    if _bitstrs(tree1) == _bitstrs(tree2):
-        return True
+
+def getTrees(treefile, matchlist, handle=None):
+    """
+    Returns list of trees at indices obtained from readSeqs. Seeks to them
+    through the tree file's offset index when there is one, otherwise reads
+    the file once. handle is an open_intermediate stream of treefile to
+    reuse across calls, so a compressed file is decompressed once when the
+    calls' indices increase.
+    """
+    index = tree_index(treefile)
+    if os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(treefile):
+        offsets = read_array(index)
+        focal_trees = []
+        with (open_intermediate(treefile) if handle == None else contextlib.nullcontext(handle)) as trees:
+            for i in sorted(set(matchlist)):
+                if i < 1 or i > len(offsets):
+                    continue
+                trees.seek(int(offsets[i - 1]))
+                focal_trees.append(trees.readline().decode().replace("\n", ""))
     else:
-        return False
+        focal_trees = [l for i, l in iter_trees(treefile, matchlist)]
+    return (focal_trees, 0)
+
+
+def compareToSpecies(tree1, tree2, spp_topology=None):
+    """Compares tree topologies. True if both trees have the same leaves and
+    the same clades. spp_topology is the precomputed topology of tree1."""
+    if spp_topology == None:
+        spp_topology = cached_topology(tree1)
+    return cached_topology(tree2) == spp_topology
 
 
 def propDiscordant(focal_trees, species_tree):
     """
     Original function
     Determines the proportion of focal_trees (which have the same site pattern as the
-    species tree) which are discordant (i.e. have a different topology)
+    species tree) which are discordant (i.e. have a different topology).
     """
-    i = 0
-    countDis = 0
-    disc_g = []
-    conc_g = []
-
-    spp_sisters = getSisters(species_tree, "s")
-    for i, tree in enumerate(focal_trees):
-        r = call(species_tree, tree, spp_sisters, i)
-        if r[0] == 1:
-            disc_g.append(r[1])
-            countDis += 1
-        elif r[0] == 0:
-            conc_g.append(r[1])
+    flags = call(focal_trees, species_tree)
+
+    disc_g = [i for i, f in enumerate(flags) if f]
+    conc_g = [i for i, f in enumerate(flags) if not f]
+    countDis = len(disc_g)
     try:
         return (
             [countDis, len(focal_trees), countDis / len(focal_trees)],
@@ -273,12 +740,10 @@ def propDiscordant(focal_trees, species_tree):
         return ([countDis, len(focal_trees), 0.0], disc_g, conc_g)
 
 
-def call(species_tree, tree, spp_sisters, i):
-    """Function to make parallel calling easier"""
-    if compareToSpecies(species_tree, tree, spp_sisters) is False:
-        return [1, i]
-    else:
-        return [0, i]
+def call(trees, species_tree):
+    """Discordance flags of a run of trees"""
+    spp_topology = cached_topology(species_tree)
+    return [compareToSpecies(species_tree, tree, spp_topology) is False for tree in trees]
 
 
 def parse_seqgen(seqfile, ntaxa, mask):
@@ -288,7 +753,7 @@ def parse_seqgen(seqfile, ntaxa, mask):
     """
     lines = []
 
-    with open(seqfile) as seqs:
+    with open_intermediate(seqfile, "rt") as seqs:
         for line in seqs:
             if re.match(r"\w", line):
                 lines.append(str.strip(line))
@@ -301,6 +766,85 @@ def parse_seqgen(seqfile, ntaxa, mask):
     return [trees[i] for i in mask]
 
 
+def encode_blocks(trees):
+    """
+    Node labels and allele codes of blocks from parse_seqgen, as (loci, p)
+    arrays.
+    """
+    if len(trees) == 0:
+        return (np.zeros((0, 0), dtype=np.int64), np.zeros((0, 0), dtype=np.uint8))
+    rows = [line.split() for tree in trees for line in tree]
+    shape = (len(trees), len(trees[0]))
+    labels = np.array([int(r[0]) for r in rows], dtype=np.int64).reshape(shape)
+    alleles = np.array([ord(r[1][0]) for r in rows], dtype=np.uint8).reshape(shape)
+    return (labels, alleles)
+
+
+def parent_array(labels, ntaxa):
+    """
+    Positions of the parents of the nodes in blocks of node labels listed
+    in preorder (as seq-gen -wa writes them), one block per row. Internal
+    nodes (labels above ntaxa) have two children; the root's parent is -1.
+    """
+    nloci, p = labels.shape
+    rows = np.arange(nloci)
+    parents = np.full((nloci, p), -1, dtype=np.int64)
+    stack = np.zeros((nloci, p), dtype=np.int64)
+    children = np.zeros((nloci, p), dtype=np.int64)
+    depth = np.zeros(nloci, dtype=np.int64)
+    for j in range(p):
+        if j > 0:
+            top = depth - 1
+            parents[:, j] = stack[rows, top]
+            children[rows, top] += 1
+            depth -= children[rows, top] == 2
+        internal = labels[:, j] > ntaxa
+        stack[rows[internal], depth[internal]] = j
+        children[rows[internal], depth[internal]] = 0
+        depth[internal] += 1
+    return parents
+
+
+def mutation_origins(labels, alleles, ntaxa):
+    """
+    Counts the mutations along each locus from its parent array, and records
+    how each tip with a non-ancestral allele got it. Returns the number of
+    mutations per locus and three (loci, ntaxa) arrays, in taxon order:
+    derived tips, derived tips whose allele arose on their own branch, and
+    the node the other derived tips inherited their allele from (else 0).
+    """
+    nloci = labels.shape[0]
+    if nloci == 0:
+        empty = np.zeros((0, ntaxa), dtype=np.int64)
+        return (np.zeros(0, dtype=np.int64), empty.astype(bool), empty.astype(bool), empty)
+    rows = np.arange(nloci)[:, None]
+    parents = parent_array(labels, ntaxa)
+    changed = (alleles != alleles[rows, np.maximum(parents, 0)]) & (parents >= 0)
+    mutations = changed.sum(axis=1)
+
+    tips = np.argsort(labels, axis=1, kind="stable")[:, :ntaxa]
+    root_allele = alleles[rows, np.argmax(labels == ntaxa + 1, axis=1)[:, None]]
+    derived = alleles[rows, tips] != root_allele
+    tip_mutation = changed[rows, tips] & derived
+    inherited = np.where(derived & ~tip_mutation, labels[rows, parents[rows, tips]], 0)
+    return (mutations, derived, tip_mutation, inherited)
+
+
+def origin_records(derived, tip_mutation, inherited):
+    """
+    Records of how each derived tip of one locus got its allele, in taxon
+    order: (taxon, 1, '0') for a mutation on the tip's branch, (taxon, 0,
+    node) for an allele inherited from node.
+    """
+    summary = []
+    for taxon in np.flatnonzero(derived):
+        if tip_mutation[taxon]:
+            summary.append((str(taxon + 1), 1, str(0)))
+        else:
+            summary.append((str(taxon + 1), 0, str(inherited[taxon])))
+    return summary
+
+
 def count_mutations(tree, ntaxa):
     """
     Takes pairs of taxa/nodes and alleles,
@@ -308,89 +852,8 @@ def count_mutations(tree, ntaxa):
     happened along the tree. Pairs must be ordered
     in same way as seq-gen output.
     """
-
-    # node/taxon IDs
-    labels = [int(tree[i].split()[0]) for i in range(len(tree))]
-    # corresponding alleles
-    alleles = [tree[i].split()[1] for i in range(len(tree))]
-    # node label for root of the whole tree
-    root = ntaxa + 1
-    # to keep track of which comparisons have already been made
-    comparisons = []
-    # to keep track of which taxon we are currently following
-    current_taxon = 1
-    # mutation counter
-    mutations = 0
-
-    while current_taxon <= ntaxa:
-        for i in range(len(labels)):
-            if (
-                labels[i] > root
-                and labels[i - 1] >= root
-                and labels[i] == labels[i - 1] + 1
-            ):  # if the current label is an ancestral node other than the root, and the previous label is an ancestral node
-                if [
-                    labels[i],
-                    labels[i - 1],
-                ] not in comparisons:  # if this comparison between nodes has not already been made
-                    if alleles[i] != alleles[i - 1]:  # if there was a mutation
-                        mutations += 1
-                        comparisons.append([labels[i], labels[i - 1]])
-                    else:
-                        comparisons.append([labels[i], labels[i - 1]])
-            elif (
-                labels[i] > root
-                and labels[i - 2] >= root
-                and labels[i] == labels[i - 2] + 1
-            ):  # if the current label is an ancestral node, and the previous ancestral node has 1 taxon descending from it
-                if [
-                    labels[i],
-                    labels[i - 2],
-                ] not in comparisons:  # if this comparison between nodes has not already been made
-                    if alleles[i] != alleles[i - 2]:  # if there was a mutation
-                        mutations += 1
-                        comparisons.append([labels[i], labels[i - 2]])
-                    else:
-                        comparisons.append([labels[i], labels[i - 2]])
-            elif (
-                labels[i] > root
-                and labels[i - 3] >= root
-                and labels[i] == labels[i - 3] + 1
-            ):  # if the current label is an ancestral node, and the previous ancestral node has 2 taxa descending from it
-                if [
-                    labels[i],
-                    labels[i - 3],
-                ] not in comparisons:  # if this comparison between nodes has not already been made
-                    if alleles[i] != alleles[i - 3]:  # if there was a mutation
-                        mutations += 1
-                        comparisons.append([labels[i], labels[i - 3]])
-                    else:
-                        comparisons.append([labels[i], labels[i - 3]])
-            elif (
-                labels[i] > root
-                and labels[i - 4] >= root
-                and labels[i] == labels[i - 4] + 2
-            ):  # if the current label is an ancestral node, and a clade with a non-subtending ancestral node is listed before it
-                if [
-                    labels[i],
-                    labels[i - 4],
-                ] not in comparisons:  # if this comparison between nodes has not already been made
-                    if alleles[i] != alleles[i - 4]:  # if there was a mutation
-                        mutations += 1
-                        comparisons.append([labels[i], labels[i - 4]])
-                    else:
-                        comparisons.append([labels[i], labels[i - 4]])
-
-            elif labels[i] == current_taxon:  # if the label is the current tip taxon
-                if labels[i - 1] >= root:  # if i - 1 is the subtending node
-                    if alleles[i] != alleles[i - 1]:  # if there was a mutation
-                        mutations += 1
-                elif labels[i - 2] >= root:  # if i-2 is the subtending node
-                    if alleles[i] != alleles[i - 2]:  # if there was a mutation
-                        mutations += 1
-                current_taxon += 1  # update current taxon
-
-    return mutations
+    labels, alleles = encode_blocks([tree])
+    return int(mutation_origins(labels, alleles, ntaxa)[0][0])
 
 
 def get_interesting(trees, nderived, ntaxa):
@@ -416,34 +879,9 @@ def summarize_interesting(tree, ntaxa):
     Summarizes the mutations that have occurred
     on the given tree.
     """
-    labels = [int(tree[i].split()[0]) for i in range(len(tree))]  # node/taxon IDs
-    alleles = [tree[i].split()[1] for i in range(len(tree))]  # alleles
-    root = ntaxa + 1
-    current_taxon = 1  # current taxon tracker
-    ancestral_allele = alleles[labels.index(root)]  # ancestral allele for the tree
-    summary = []  # list of how each taxon got its mutation
-
-    while current_taxon <= ntaxa:
-        for i in range(len(labels)):
-            if labels[i] == current_taxon:
-                if alleles[i] == ancestral_allele:  # if the taxon has ancestral state
-                    current_taxon += 1  # move on
-                elif alleles[i] != ancestral_allele:  # if taxon has the derived state
-                    if labels[i - 1] >= root:  # if i-1 is the subtending node
-                        if (
-                            alleles[i] != alleles[i - 1]
-                        ):  # if there was a mutation on the tip branch
-                            summary.append((str(labels[i]), 1, str(0)))
-                        else:  # if the derived state was inherited from an ancestor
-                            summary.append((str(labels[i]), 0, str(labels[i - 1])))
-                    elif labels[i - 2] >= root:  # if i-2 is the subtending node
-                        if alleles[i] != alleles[i - 2]:  # if there was a tip mutation
-                            summary.append((str(labels[i]), 1, str(0)))
-                        else:  # if derived state was inherited
-                            summary.append((str(labels[i]), 0, str(labels[i - 2])))
-                    current_taxon += 1  # update current taxon
-
-    return summary
+    labels, alleles = encode_blocks([tree])
+    mutations, derived, tip_mutation, inherited = mutation_origins(labels, alleles, ntaxa)
+    return origin_records(derived[0], tip_mutation[0], inherited[0])
 
 
 def sum_counts_by_tree(counts):
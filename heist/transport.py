@@ -0,0 +1,157 @@
+# /usr/bin/python3
+import os
+import itertools
+import numpy as np
+from multiprocessing import shared_memory
+
+"""
+Hemiplasy Tool
+Authors: Matt Gibson, Mark Hibbins
+Indiana University
+
+Shared memory transport of array arguments from the parent to analysis
+worker processes. With seqtools.ordered_map(shared=True), the NumPy arrays
+of each job are copied once into a shared memory slot and the workers are
+sent small references (SharedArray) instead of pickled arrays; they use the
+arrays in place. This does not carry the simulations' output: ms and
+seq-gen are external programs, and their gene trees and sequences still
+reach the analysis through the intermediate files.
+"""
+
+# Where POSIX shared memory lives; slots that would not fit are not created
+SHM_DIR = "/dev/shm"
+
+# Alignment of the arrays within a slot
+ALIGN = 64
+
+# Numbers identifying the rings of this (parent) process
+ring_ids = itertools.count()
+
+
+class SharedArray(object):
+    """
+    Reference to an array in a shared memory segment, sent in place of the
+    array: the ring and slot it is in, and the segment's name.
+    """
+    __slots__ = ("ring", "slot", "name", "offset", "dtype", "shape")
+
+    def __init__(self, ring, slot, name, offset, dtype, shape):
+        self.ring = ring
+        self.slot = slot
+        self.name = name
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+
+
+class SlotRing(object):
+    """
+    Ring of shared memory slots, one per job in flight: the arrays of job i
+    go to slot i % nslots. ordered_map keeps at most nslots jobs in flight,
+    so a slot is only reused once the job before has finished with it.
+    Each slot is a segment that grows to fit its largest job.
+    """
+    __slots__ = ("id", "segments", "count")
+
+    def __init__(self, nslots):
+        self.id = (os.getpid(), next(ring_ids))
+        self.segments = [None] * nslots
+        self.count = 0
+
+    def put(self, args):
+        """
+        Job arguments with each array replaced by a SharedArray in the next
+        slot. If the slot cannot grow to fit them, the arrays are left to be
+        pickled.
+        """
+        slot = self.count % len(self.segments)
+        self.count += 1
+        size = sum([aligned(a.nbytes) for a in args if isinstance(a, np.ndarray)])
+        if size == 0:
+            return args
+        segment = self.segments[slot]
+        if segment == None or segment.size < size:
+            grow = size if segment == None else max(size, 2 * segment.size)
+            if not has_room(grow):
+                return args
+            if segment != None:
+                segment.close()
+                segment.unlink()
+            segment = shared_memory.SharedMemory(create=True, size=grow)
+            self.segments[slot] = segment
+
+        shared = []
+        offset = 0
+        for a in args:
+            if isinstance(a, np.ndarray):
+                np.ndarray(a.shape, dtype=a.dtype, buffer=segment.buf, offset=offset)[...] = a
+                shared.append(SharedArray(self.id, slot, segment.name, offset, a.dtype.str, a.shape))
+                offset += aligned(a.nbytes)
+            else:
+                shared.append(a)
+        return shared
+
+    def close(self):
+        """Releases the slots."""
+        for segment in self.segments:
+            if segment != None:
+                segment.close()
+                segment.unlink()
+        self.segments = [None] * len(self.segments)
+
+
+def aligned(nbytes):
+    return -(-nbytes // ALIGN) * ALIGN
+
+
+def has_room(nbytes):
+    """True if nbytes more of shared memory fit, with as much to spare."""
+    try:
+        st = os.statvfs(SHM_DIR)
+    except OSError:
+        return True
+    return st.f_bavail * st.f_frsize >= 2 * nbytes
+
+
+# Segments mapped by this (worker) process, by ring and slot. A slot's
+# segment is closed as soon as a job uses a new segment in its place (the
+# slot grew, or a new ring began), so replaced segments are not kept mapped.
+# call releases a job's views when it returns, so nothing still views a
+# segment when it is closed.
+attached = {}
+
+
+def detach(key):
+    """Closes the segment mapped for a (ring, slot) key."""
+    attached.pop(key).close()
+
+
+def resolve(args):
+    """Job arguments with each SharedArray replaced by a read-only view of its array."""
+    resolved = []
+    for a in args:
+        if isinstance(a, SharedArray):
+            key = (a.ring, a.slot)
+            for old in [k for k in attached if k[0] != a.ring or (k == key and attached[k].name != a.name)]:
+                detach(old)
+            if key not in attached:
+                attached[key] = shared_memory.SharedMemory(name=a.name)
+            view = np.ndarray(a.shape, dtype=np.dtype(a.dtype), buffer=attached[key].buf, offset=a.offset)
+            view.flags.writeable = False
+            resolved.append(view)
+        else:
+            resolved.append(a)
+    return resolved
+
+
+def call(func, args):
+    """
+    Runs func on job arguments from SlotRing.put, in a worker. The views of
+    the shared arrays are dropped before returning; func must not return
+    or keep them.
+    """
+    views = resolve(args)
+    try:
+        return func(*views)
+    finally:
+        del views
@@ -0,0 +1,350 @@
+# /usr/bin/python3
+import math
+import re
+
+"""
+Hemiplasy Tool
+Authors: Matt Gibson, Mark Hibbins
+Indiana University
+
+Array-backed Newick trees for preprocessing species trees: parsing,
+relabeling, pruning, ultrametric conversion, Newick writing and ASCII
+drawing. Nodes are integer indices into parallel lists of names, branch
+lengths, parents and children. Results (node order, float arithmetic and
+output formatting) follow ete3 and Biopython, which were used before.
+"""
+
+# Brackets, commas and semicolons; branch lengths; names
+TOKEN = re.compile(r"\s*([(),;]|:[^(),;]*|[^(),:;]+)")
+
+
+class Tree(object):
+    """
+    A rooted tree parsed from a Newick string, with internal node names
+    (ete3 format 1). Missing branch lengths are 1, except at the root (0).
+    """
+    __slots__ = ("names", "dists", "parent", "children", "root")
+
+    def __init__(self, newick):
+        self.names = []
+        self.dists = []
+        self.parent = []
+        self.children = []
+        self.root = 0
+        current = -1
+        last = -1
+        for token in TOKEN.findall(newick):
+            if token == "(":
+                current = self.add_node(current)
+                last = -1
+            elif token == ",":
+                last = -1
+            elif token == ")":
+                last = current
+                current = self.parent[current]
+            elif token == ";":
+                break
+            elif token[0] == ":":
+                if last == -1:
+                    last = self.add_node(current)
+                self.dists[last] = float(token[1:])
+            elif last == -1:
+                last = self.add_node(current)
+                self.names[last] = token.strip()
+            else:
+                self.names[last] = token.strip()
+        if len(self.names) == 0:
+            self.add_node(-1)
+
+    def add_node(self, parent, name="", dist=None):
+        """Adds a node as the last child of parent (-1 for the root)."""
+        node = len(self.names)
+        self.names.append(name)
+        self.dists.append((0.0 if parent == -1 else 1.0) if dist == None else dist)
+        self.parent.append(parent)
+        self.children.append([])
+        if parent != -1:
+            self.children[parent].append(node)
+        return node
+
+    def copy(self):
+        """Independent copy of the tree."""
+        t = Tree.__new__(Tree)
+        t.names = list(self.names)
+        t.dists = list(self.dists)
+        t.parent = list(self.parent)
+        t.children = [list(c) for c in self.children]
+        t.root = self.root
+        return t
+
+    def is_leaf(self, node):
+        return len(self.children[node]) == 0
+
+    def preorder(self, node=None):
+        """Nodes under node (default the root) in preorder."""
+        stack = [self.root if node == None else node]
+        while stack:
+            n = stack.pop()
+            yield n
+            stack.extend(reversed(self.children[n]))
+
+    def postorder(self, node=None):
+        """Nodes under node (default the root) in postorder."""
+        return reversed(list(self._reverse_preorder(node)))
+
+    def _reverse_preorder(self, node=None):
+        """Preorder with children visited last to first."""
+        stack = [self.root if node == None else node]
+        while stack:
+            n = stack.pop()
+            yield n
+            stack.extend(self.children[n])
+
+    def levelorder(self, node=None):
+        """Nodes under node (default the root), level by level."""
+        queue = [self.root if node == None else node]
+        i = 0
+        while i < len(queue):
+            queue.extend(self.children[queue[i]])
+            i += 1
+        return queue
+
+    def leaves(self, node=None):
+        """Leaves under node (default the root), in preorder."""
+        return [n for n in self.preorder(node) if self.is_leaf(n)]
+
+    def leaf_names(self, node=None):
+        return [self.names[n] for n in self.leaves(node)]
+
+    def depth(self, node):
+        """Number of ancestors of node."""
+        d = 0
+        while self.parent[node] != -1:
+            node = self.parent[node]
+            d += 1
+        return d
+
+    def ancestors(self, node):
+        """node and its ancestors, up to the root."""
+        path = [node]
+        while self.parent[path[-1]] != -1:
+            path.append(self.parent[path[-1]])
+        return path
+
+    def common_ancestor(self, nodes):
+        """Most recent common ancestor of nodes."""
+        common = self.ancestors(nodes[0])
+        for node in nodes[1:]:
+            path = set(self.ancestors(node))
+            common = [n for n in common if n in path]
+        return common[0]
+
+    def distance(self, a, b):
+        """Branch length distance between nodes a and b (a's path summed first)."""
+        ancestor = self.common_ancestor([a, b])
+        dist = 0.0
+        for n in [a, b]:
+            while n != ancestor:
+                dist += self.dists[n]
+                n = self.parent[n]
+        return dist
+
+    def farthest_leaf(self):
+        """The leaf farthest from the root, and its distance."""
+        max_node = self.root
+        max_dist = 0.0 if self.is_leaf(self.root) else None
+        d = 0.0
+        stack = [(False, self.root)]
+        while stack:
+            post, n = stack.pop()
+            if n != self.root:
+                if post:
+                    d -= self.dists[n]
+                elif self.is_leaf(n):
+                    if max_dist == None or d + self.dists[n] > max_dist:
+                        max_dist = d + self.dists[n]
+                        max_node = n
+                else:
+                    d += self.dists[n]
+            if not post and not self.is_leaf(n):
+                stack.append((True, n))
+                stack.extend([(False, c) for c in reversed(self.children[n])])
+        return (max_node, max_dist)
+
+    def detach(self, node):
+        """Removes node from its parent's children."""
+        self.children[self.parent[node]].remove(node)
+        self.parent[node] = -1
+
+    def attach(self, node, parent):
+        """Makes node the last child of parent."""
+        self.children[parent].append(node)
+        self.parent[node] = parent
+
+    def delete(self, node, prevent_nondicotomic=True, preserve_branch_length=False):
+        """
+        Removes node, passing its children to its parent. With
+        prevent_nondicotomic, a parent left with a single child is removed
+        as well; with preserve_branch_length, removed branch lengths are
+        added to the remaining branches.
+        """
+        parent = self.parent[node]
+        if parent != -1:
+            if preserve_branch_length:
+                if len(self.children[node]) == 1:
+                    self.dists[self.children[node][0]] += self.dists[node]
+                elif len(self.children[node]) > 1:
+                    self.dists[parent] += self.dists[node]
+            for child in list(self.children[node]):
+                self.attach(child, parent)
+            self.children[node] = []
+            self.detach(node)
+        if prevent_nondicotomic and parent != -1 and len(self.children[parent]) < 2:
+            self.delete(parent, False, preserve_branch_length)
+
+    def relabel(self, conversions):
+        """Renames leaves by the conversions dictionary."""
+        for n in self.leaves():
+            self.names[n] = str(conversions.get(self.names[n], self.names[n]))
+
+    def monophyletic(self, names):
+        """Largest clades whose leaves are all in names, in preorder."""
+        names = set(names)
+        inside = {}
+        for n in self.postorder():
+            if self.is_leaf(n):
+                inside[n] = self.names[n] in names
+            else:
+                inside[n] = all([inside[c] for c in self.children[n]])
+        clades = []
+        stack = [self.root]
+        while stack:
+            n = stack.pop()
+            if inside[n]:
+                clades.append(n)
+            else:
+                stack.extend(reversed(self.children[n]))
+        return clades
+
+    def prune(self, names):
+        """
+        Keeps only the leaves in names and the nodes where their lineages
+        split; the root is always kept. Branch lengths of removed nodes are
+        dropped.
+        """
+        seeds = [n for n in self.leaves() if self.names[n] in names]
+        visitors = {}
+        for seed in seeds:
+            for n in self.ancestors(seed)[1:]:
+                visitors.setdefault(n, set()).add(seed)
+        keep = set(seeds)
+        keep.add(self.root)
+        groups = {}
+        for n, v in visitors.items():
+            if len(v) > 1:
+                groups.setdefault(frozenset(v), []).append(n)
+        for nodes in groups.values():
+            if not keep & set(nodes):
+                keep.add(max(nodes, key = self.depth))
+        for n in list(self.postorder())[:-1]:
+            if n not in keep:
+                self.delete(n, prevent_nondicotomic=False)
+
+    def to_ultrametric(self):
+        """
+        Makes all leaves equidistant from the root at the current tree
+        height, spreading each path's length evenly over its splits.
+        """
+        max_depth = {}
+        for n in self.postorder():
+            if self.is_leaf(n):
+                max_depth[n] = 1
+            else:
+                max_depth[n] = max([max_depth[c] for c in self.children[n]]) + 1
+        height = self.farthest_leaf()[1]
+        node_dist = {self.root: 0.0}
+        for n in self.levelorder()[1:]:
+            up = self.parent[n]
+            self.dists[n] = (height - node_dist[up]) / max_depth[n]
+            node_dist[n] = self.dists[n] + node_dist[up]
+
+    def extend_ultrametric(self):
+        """Makes all leaves equidistant from the root by extending tip branches."""
+        height = self.farthest_leaf()[1]
+        for n in self.leaves():
+            self.dists[n] += (height - self.distance(n, self.root))
+
+    def write(self, format=0, dist_formatter="%0.6g"):
+        """
+        Newick string of the tree. Internal nodes are labelled with their
+        support (always 1) in format 0, with their names in format 1, and
+        not at all in format 5. Format 9 has leaf names only, without
+        branch lengths.
+        """
+        out = []
+        stack = [self.root]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                out.append(item)
+            elif self.is_leaf(item):
+                out.append(self.names[item] + ("" if format == 9 else ":" + dist_formatter % self.dists[item]))
+            else:
+                out.append("(")
+                if item == self.root or format == 9:
+                    stack.append(")")
+                else:
+                    label = {0: "1", 1: self.names[item]}.get(format, "")
+                    stack.append(")" + label + ":" + dist_formatter % self.dists[item])
+                kids = self.children[item]
+                for i in range(len(kids) - 1, -1, -1):
+                    stack.append(kids[i])
+                    if i > 0:
+                        stack.append(",")
+        return "".join(out) + ";"
+
+    def draw_ascii(self, file, column_width=80):
+        """Writes an ASCII drawing of the tree to file, as Biopython's Phylo.draw_ascii."""
+        taxa = self.leaves()
+        max_label_width = max([len(self.names[n]) for n in taxa])
+        drawing_width = column_width - max_label_width - 1
+        drawing_height = 2 * len(taxa) - 1
+
+        depths = {self.root: self.dists[self.root]}
+        for n in self.preorder():
+            for c in self.children[n]:
+                depths[c] = depths[n] + self.dists[c]
+        if max(depths.values()) == 0:
+            depths = {n: self.dists[self.root] + self.depth(n) for n in depths}
+        fudge_margin = int(math.ceil(math.log(len(taxa), 2)))
+        cols_per_branch_unit = (drawing_width - fudge_margin) / float(max(depths.values()))
+        cols = {n: int(d * cols_per_branch_unit + 1.0) for n, d in depths.items()}
+
+        rows = {n: 2 * i for i, n in enumerate(taxa)}
+        for n in self.postorder():
+            if not self.is_leaf(n):
+                rows[n] = (rows[self.children[n][0]] + rows[self.children[n][-1]]) // 2
+
+        matrix = [[" " for x in range(drawing_width)] for y in range(drawing_height)]
+        stack = [(self.root, 0)]
+        while stack:
+            n, startcol = stack.pop()
+            thiscol = cols[n]
+            thisrow = rows[n]
+            for col in range(startcol, thiscol):
+                matrix[thisrow][col] = "_"
+            if not self.is_leaf(n):
+                toprow = rows[self.children[n][0]]
+                botrow = rows[self.children[n][-1]]
+                for row in range(toprow + 1, botrow + 1):
+                    matrix[row][thiscol] = "|"
+                if (cols[self.children[n][0]] - thiscol) < 2:
+                    matrix[toprow][thiscol] = ","
+                stack.extend([(c, thiscol + 1) for c in reversed(self.children[n])])
+
+        for idx, row in enumerate(matrix):
+            line = "".join(row).rstrip()
+            if idx % 2 == 0:
+                line += " " + self.names[taxa[idx // 2]]
+            file.write(line + "\n")
+        file.write("\n")
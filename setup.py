@@ -8,7 +8,7 @@ HERE = pathlib.Path(__file__).parent
 README = (HERE / "README.md").read_text()
 
 # specify requirements of your package here
-REQUIREMENTS = ['biopython', 'numpy', 'matplotlib', 'ete3']
+REQUIREMENTS = ['numpy', 'matplotlib']
 
 setup(name='heist-hemiplasy',
       version='0.3.1',
@@ -21,6 +21,7 @@ setup(name='heist-hemiplasy',
       license='MIT',
       packages=['heist'],
       install_requires=REQUIREMENTS,
+      extras_require={'jit': ['numba'], 'zstd': ['zstandard']},
       entry_points={
         "console_scripts": [
             "heist=heist.__main__:main",